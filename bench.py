@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("STATE_DB", "")
+os.environ.setdefault("SEARCH_CACHE_FILE", "")
+os.environ.setdefault("EXTRACT_EXECUTOR", "thread")
+os.environ.setdefault("PREFETCH_CHECK_URL", "0")
+os.environ.setdefault("AUDIO_CACHE_MAX_MB", "0")
+os.environ.setdefault("STREAM_PROXY_PORT", "0")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("TRACE_FILE", "")
+os.environ.setdefault("SESSION_DIR", os.path.join("data", "bench_sessions"))
+
+import bot  # noqa: E402
+
+
+class Faults:
+    def __init__(self, latency_ms: float, failure_rate: float) -> None:
+        self.latency = latency_ms / 1000
+        self.failure_rate = failure_rate
+        self.outage = False
+        self.calls = 0
+
+    def jitter(self) -> float:
+        return random.uniform(self.latency * 0.5, self.latency * 1.5) if self.latency > 0 else 0.0
+
+    def check(self, what: str) -> None:
+        self.calls += 1
+        if self.outage or (self.failure_rate > 0 and random.random() < self.failure_rate):
+            raise RuntimeError(f"Simulated {what} failure")
+
+
+class FakeTelegram:
+    faults = Faults(0, 0)
+
+    def __init__(self, name: str = "", **kwargs: Any) -> None:
+        self.name = name
+        self.handlers: Dict[str, Callable] = {}
+        self.sent = 0
+
+    def on_message(self, flt: Any = None, *args: Any, **kwargs: Any) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            for command in getattr(flt, "commands", ()):
+                self.handlers[command.lower()] = func
+            return func
+
+        return decorator
+
+    def on_chat_member_updated(self, *args: Any, **kwargs: Any) -> Callable:
+        return lambda func: func
+
+    def start(self) -> None:
+        pass
+
+    async def send_message(self, chat_id: int, text: str, **kwargs: Any) -> Any:
+        await asyncio.sleep(self.faults.jitter())
+        self.sent += 1
+        return SimpleNamespace(id=self.sent)
+
+    async def get_chat(self, chat_id: int) -> Any:
+        await asyncio.sleep(self.faults.jitter())
+        self.faults.check("get_chat")
+        return SimpleNamespace(id=chat_id)
+
+
+class FakeCalls:
+    faults = Faults(0, 0)
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+        self.handler: Optional[Callable] = None
+        self.playing: Dict[int, Any] = {}
+
+    def on_update(self, *args: Any, **kwargs: Any) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            self.handler = func
+            return func
+
+        return decorator
+
+    def start(self) -> None:
+        pass
+
+    async def play(self, chat_id: int, stream: Any) -> None:
+        await asyncio.sleep(self.faults.jitter())
+        self.faults.check("calls.play")
+        self.playing[chat_id] = stream
+
+    async def pause_stream(self, chat_id: int) -> None:
+        await asyncio.sleep(self.faults.jitter())
+
+    async def resume_stream(self, chat_id: int) -> None:
+        await asyncio.sleep(self.faults.jitter())
+
+    async def leave_group_call(self, chat_id: int) -> None:
+        await asyncio.sleep(self.faults.jitter())
+        self.playing.pop(chat_id, None)
+
+
+class FakeYoutubeDL:
+    faults = Faults(0, 0)
+
+    def __init__(self, opts: Dict[str, Any]) -> None:
+        self.opts = opts
+
+    def close(self) -> None:
+        pass
+
+    def extract_info(self, query: str, download: bool = False) -> Dict[str, Any]:
+        time.sleep(self.faults.jitter())
+        self.faults.check("extract")
+        video_id = query.replace(" ", "_")
+        expire = int(time.time()) + 21600
+        return {
+            "entries": [
+                {
+                    "title": query,
+                    "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+                    "url": f"https://rr1.googlevideo.com/videoplayback?id={video_id}&expire={expire}",
+                    "duration": 180,
+                }
+            ]
+        }
+
+
+class StreamAudioEnded:
+    def __init__(self, chat_id: int) -> None:
+        self.chat_id = chat_id
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int, command: List[str], user_id: int) -> None:
+        self.id = random.randint(1, 1 << 30)
+        self.command = command
+        self.chat = SimpleNamespace(id=chat_id, type=bot.ChatType.SUPERGROUP)
+        self.from_user = SimpleNamespace(id=user_id, mention=f"user{user_id}")
+        self.privileged = True
+        self.replies: List[str] = []
+
+    async def reply_text(self, text: str, **kwargs: Any) -> Any:
+        await asyncio.sleep(FakeTelegram.faults.jitter())
+        self.replies.append(text)
+        return SimpleNamespace(id=len(self.replies))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+        "mean_ms": round(statistics.fmean(values) * 1000, 2) if values else 0.0,
+    }
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.bot = FakeTelegram("bench_bot")
+        self.user, self.calls = bot.build_user_clients()
+        bot.register_handlers(self.bot, self.calls, self.user)
+        self.play = self.bot.handlers["play"]
+        self.errors: List[str] = []
+
+    async def play_command(self, chat_id: int, query: str) -> float:
+        message = FakeMessage(chat_id, ["play", query], chat_id % 1000 + 1)
+        started = time.perf_counter()
+        await self.play(self.bot, message)
+        elapsed = time.perf_counter() - started
+        if message.replies and message.replies[-1].startswith(("Ошибка", "Сейчас слишком")):
+            self.errors.append(message.replies[-1])
+        return elapsed
+
+    async def load_phase(self, chat_ids: List[int]) -> List[float]:
+        total = int(self.args.rate * self.args.duration)
+        interval = 1 / self.args.rate
+        tasks = []
+        for i in range(total):
+            chat_id = chat_ids[i % len(chat_ids)] if i < len(chat_ids) else random.choice(chat_ids)
+            query = f"track {random.randrange(self.args.queries)}"
+            tasks.append(asyncio.create_task(self.play_command(chat_id, query)))
+            await asyncio.sleep(interval)
+        return list(await asyncio.gather(*tasks))
+
+    async def switch_phase(self, chat_ids: List[int]) -> List[float]:
+        gaps: List[float] = []
+
+        async def end_track(chat_id: int) -> None:
+            if not bot.active_calls.get(chat_id) or await bot.queue.size(chat_id) < 2:
+                return
+            handler = bot.session_pool.shard_for(chat_id).calls.handler
+            started = time.perf_counter()
+            await handler(None, StreamAudioEnded(chat_id))
+            gaps.append(time.perf_counter() - started)
+
+        for _ in range(self.args.switch_rounds):
+            await asyncio.gather(*(end_track(chat_id) for chat_id in chat_ids))
+        return gaps
+
+    async def storm_phase(self, chat_ids: List[int]) -> Dict[str, Any]:
+        active = [chat_id for chat_id in chat_ids if bot.active_calls.get(chat_id)]
+        FakeCalls.faults.outage = True
+        started = time.perf_counter()
+        for chat_id in active:
+            bot.ensure_reconnect(chat_id, self.calls, self.bot, self.user)
+        await asyncio.sleep(self.args.outage_seconds)
+        FakeCalls.faults.outage = False
+        outage_ended = time.perf_counter()
+        deadline = outage_ended + self.args.storm_timeout
+        while any(chat_id in bot.reconnect_tasks for chat_id in active) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        finished = time.perf_counter()
+        recovered = sum(1 for chat_id in active if bot.active_calls.get(chat_id) and chat_id not in bot.reconnect_tasks)
+        return {
+            "chats": len(active),
+            "recovered": recovered,
+            "recovery_after_outage_s": round(finished - outage_ended, 3),
+            "total_s": round(finished - started, 3),
+            "timed_out": finished >= deadline,
+            "scheduler": bot.reconnect_scheduler.stats(),
+        }
+
+    async def run(self) -> Dict[str, Any]:
+        chat_ids = [-1000000000000 - i for i in range(self.args.chats)]
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        play_latencies = await self.load_phase(chat_ids)
+        populated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        gaps = await self.switch_phase(chat_ids)
+        storm = await self.storm_phase(chat_ids) if self.args.outage_seconds > 0 else {}
+        return {
+            "play": summarize(play_latencies),
+            "play_errors": len(self.errors),
+            "track_switch_gap": summarize(gaps),
+            "memory_per_chat_bytes": round((populated - baseline) / max(1, len(chat_ids))),
+            "reconnect_storm": storm,
+            "queues": bot.queue.stats(),
+            "search_cache": bot.search_cache.stats(),
+            "extractor_calls": FakeYoutubeDL.faults.calls,
+            "telegram_messages": self.bot.sent,
+        }
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test of the bot handlers with fake Telegram clients.")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=20, help="/play commands per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of /play traffic")
+    parser.add_argument("--queries", type=int, default=100, help="distinct search queries")
+    parser.add_argument("--switch-rounds", type=int, default=3)
+    parser.add_argument("--telegram-latency-ms", type=float, default=30)
+    parser.add_argument("--telegram-failure-rate", type=float, default=0)
+    parser.add_argument("--play-latency-ms", type=float, default=80)
+    parser.add_argument("--play-failure-rate", type=float, default=0)
+    parser.add_argument("--search-latency-ms", type=float, default=400)
+    parser.add_argument("--search-failure-rate", type=float, default=0)
+    parser.add_argument("--outage-seconds", type=float, default=3, help="0 skips the reconnect storm")
+    parser.add_argument("--storm-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> None:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    FakeTelegram.faults = Faults(args.telegram_latency_ms, args.telegram_failure_rate)
+    FakeCalls.faults = Faults(args.play_latency_ms, args.play_failure_rate)
+    FakeYoutubeDL.faults = Faults(args.search_latency_ms, args.search_failure_rate)
+    bot.Client = FakeTelegram
+    bot.PyTgCalls = FakeCalls
+    bot.YoutubeDL = FakeYoutubeDL
+    bot.AudioPiped = None
+    bot.MediaStream = None
+
+    started = time.time()
+    results = asyncio.run(Bench(args).run())
+    report = {
+        "started_at": started,
+        "elapsed_s": round(time.time() - started, 3),
+        "python": sys.version.split()[0],
+        "params": vars(args),
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
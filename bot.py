@@ -1,14 +1,38 @@
 import asyncio
+import cProfile
+import hashlib
+import heapq
+import json
 import logging
 import os
-from dataclasses import dataclass
+import pstats
+import random
+import re
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, replace
 from pathlib import Path
-from typing import Dict, List, Optional, Set
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
 
 from dotenv import load_dotenv
-from pyrogram import Client, filters
-from pyrogram.enums import ChatMemberStatus, ChatType
-from pyrogram.types import Message
+from pyrogram import Client, filters, idle
+from pyrogram.enums import ChatMembersFilter, ChatMemberStatus, ChatType
+from pyrogram.errors import FloodWait
+from pyrogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
 
 # Compatibility shim for Pyrogram error name changes.
 try:
@@ -31,6 +55,11 @@ try:
     from pytgcalls.types.input_stream import AudioPiped
 except Exception:
     AudioPiped = None
+
+try:
+    from pytgcalls.types import MediaStream
+except Exception:
+    MediaStream = None
 from yt_dlp import YoutubeDL
 
 try:
@@ -54,100 +83,2405 @@ API_HASH = os.getenv("API_HASH", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 SESSION_NAME = os.getenv("SESSION_NAME", "music_user")
 SESSION_DIR = os.getenv("SESSION_DIR", "data/sessions")
+SESSION_NAMES_RAW = os.getenv("SESSION_NAMES", "")
+SESSION_MAX_CALLS = int(os.getenv("SESSION_MAX_CALLS", "0"))
+SESSION_FAILURE_THRESHOLD = int(os.getenv("SESSION_FAILURE_THRESHOLD", "3"))
+SESSION_RETRY_SECONDS = int(os.getenv("SESSION_RETRY_SECONDS", "60"))
+RUN_MODE = os.getenv("RUN_MODE", "single").lower()
+BROKER_URL = os.getenv("BROKER_URL", "tcp://127.0.0.1:8790")
+PARTITIONS = int(os.getenv("PARTITIONS", "64"))
+WORKER_ID = os.getenv("WORKER_ID", "") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_HEARTBEAT_SECONDS = int(os.getenv("WORKER_HEARTBEAT_SECONDS", "5"))
+WORKER_TIMEOUT_SECONDS = int(os.getenv("WORKER_TIMEOUT_SECONDS", "20"))
+WORKER_HANDOFF_SECONDS = int(os.getenv("WORKER_HANDOFF_SECONDS", "3"))
+FRONT_RELAY_CONCURRENCY = int(os.getenv("FRONT_RELAY_CONCURRENCY", "8"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_SIGNAL_SECONDS = int(os.getenv("PROFILE_SIGNAL_SECONDS", "30"))
+LOOP_MONITOR_INTERVAL_MS = int(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100"))
+LOOP_STALL_THRESHOLD_MS = int(os.getenv("LOOP_STALL_THRESHOLD_MS", "500"))
+LOOP_STALL_HISTORY = int(os.getenv("LOOP_STALL_HISTORY", "5"))
 PRIVILEGED_USER_IDS_RAW = os.getenv("PRIVILEGED_USER_IDS", "")
+ADMIN_CACHE_TTL_SECONDS = int(os.getenv("ADMIN_CACHE_TTL_SECONDS", "600"))
 RECONNECT_DELAY_SECONDS = int(os.getenv("RECONNECT_DELAY_SECONDS", "8"))
+RECONNECT_MAX_DELAY_SECONDS = int(os.getenv("RECONNECT_MAX_DELAY_SECONDS", "120"))
 RECONNECT_MAX_ATTEMPTS = int(os.getenv("RECONNECT_MAX_ATTEMPTS", "0"))
+RECONNECT_CONCURRENCY = int(os.getenv("RECONNECT_CONCURRENCY", "4"))
+RECONNECT_RATE_PER_SECOND = float(os.getenv("RECONNECT_RATE_PER_SECOND", "2"))
+RECONNECT_BURST = int(os.getenv("RECONNECT_BURST", "4"))
+RECONNECT_BREAKER_THRESHOLD = int(os.getenv("RECONNECT_BREAKER_THRESHOLD", "6"))
+RECONNECT_BREAKER_COOLDOWN_SECONDS = int(os.getenv("RECONNECT_BREAKER_COOLDOWN_SECONDS", "300"))
+OUTBOX_RATE_PER_SECOND = float(os.getenv("OUTBOX_RATE_PER_SECOND", "20"))
+OUTBOX_CHAT_INTERVAL_SECONDS = float(os.getenv("OUTBOX_CHAT_INTERVAL_SECONDS", "1"))
+OUTBOX_CHAT_LIMIT = int(os.getenv("OUTBOX_CHAT_LIMIT", "20"))
+NODE_MAX_STREAMS = int(os.getenv("NODE_MAX_STREAMS", "0"))
+NODE_MAX_LOAD = float(os.getenv("NODE_MAX_LOAD", "0"))
+NODE_MIN_FREE_MB = int(os.getenv("NODE_MIN_FREE_MB", "0"))
+NODE_WAITLIST = os.getenv("NODE_WAITLIST", "1") == "1"
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "0"))
+FFMPEG_QUEUE_SIZE = int(os.getenv("FFMPEG_QUEUE_SIZE", "0"))
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", "0"))
+FFMPEG_EXTRA_ARGS = os.getenv("FFMPEG_EXTRA_ARGS", "")
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+SEARCH_CACHE_TTL_SECONDS = int(os.getenv("SEARCH_CACHE_TTL_SECONDS", "3600"))
+SEARCH_CACHE_EXPIRY_MARGIN_SECONDS = int(os.getenv("SEARCH_CACHE_EXPIRY_MARGIN_SECONDS", "600"))
+SEARCH_CACHE_FILE = os.getenv("SEARCH_CACHE_FILE", "")
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+EXTRACT_EXECUTOR = os.getenv("EXTRACT_EXECUTOR", "thread").lower()
+EXTRACT_QUEUE_LIMIT = int(os.getenv("EXTRACT_QUEUE_LIMIT", "64"))
+EXTRACT_CHAT_QUEUE_LIMIT = int(os.getenv("EXTRACT_CHAT_QUEUE_LIMIT", "8"))
+YTDL_POOL_SIZE = int(os.getenv("YTDL_POOL_SIZE", str(EXTRACT_WORKERS)))
+YTDL_RECYCLE_AFTER = int(os.getenv("YTDL_RECYCLE_AFTER", "200"))
+YTDL_MAX_AGE_SECONDS = int(os.getenv("YTDL_MAX_AGE_SECONDS", "3600"))
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_CHECK_URL = os.getenv("PREFETCH_CHECK_URL", "1") == "1"
+STREAM_URL_MIN_TTL_SECONDS = int(os.getenv("STREAM_URL_MIN_TTL_SECONDS", "120"))
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "data/audio_cache")
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "0"))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "2"))
+AUDIO_CACHE_MAX_TRACK_SECONDS = int(os.getenv("AUDIO_CACHE_MAX_TRACK_SECONDS", "1200"))
+AUDIO_CACHE_BITRATE = os.getenv("AUDIO_CACHE_BITRATE", "128k")
+STREAM_PROXY_PORT = int(os.getenv("STREAM_PROXY_PORT", "0"))
+STREAM_PROXY_HOST = os.getenv("STREAM_PROXY_HOST", "127.0.0.1")
+STREAM_PROXY_DIR = os.getenv("STREAM_PROXY_DIR", "data/stream_proxy")
+STREAM_PROXY_LINGER_SECONDS = int(os.getenv("STREAM_PROXY_LINGER_SECONDS", "120"))
+STREAM_PROXY_MAX_TRACK_SECONDS = int(os.getenv("STREAM_PROXY_MAX_TRACK_SECONDS", "3600"))
+QUEUE_PAGE_SIZE = 20
+LIBRARY_DIR = os.getenv("LIBRARY_DIR", "")
+LIBRARY_DB = os.getenv("LIBRARY_DB", "data/library.db")
+LIBRARY_SCAN_WORKERS = int(os.getenv("LIBRARY_SCAN_WORKERS", "4"))
+LIBRARY_RESCAN_SECONDS = int(os.getenv("LIBRARY_RESCAN_SECONDS", "0"))
+LIBRARY_EXTENSIONS = {
+    ext.strip().lower()
+    for ext in os.getenv("LIBRARY_EXTENSIONS", ".mp3,.flac,.ogg,.opus,.m4a,.wav").split(",")
+    if ext.strip()
+}
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "5"))
+SEARCH_RESULTS_TTL_SECONDS = int(os.getenv("SEARCH_RESULTS_TTL_SECONDS", "300"))
+REAPER_INTERVAL_SECONDS = int(os.getenv("REAPER_INTERVAL_SECONDS", "60"))
+REAPER_IDLE_SECONDS = int(os.getenv("REAPER_IDLE_SECONDS", "3600"))
+REAPER_EMPTY_CALL_SECONDS = int(os.getenv("REAPER_EMPTY_CALL_SECONDS", "300"))
+REAPER_PROBE_BATCH = int(os.getenv("REAPER_PROBE_BATCH", "10"))
+REAPER_PROBE_CONCURRENCY = int(os.getenv("REAPER_PROBE_CONCURRENCY", "2"))
+PLAYLIST_MAX_TRACKS = int(os.getenv("PLAYLIST_MAX_TRACKS", "500"))
+STATE_DB = os.getenv("STATE_DB", "data/state.db")
+STATE_FLUSH_INTERVAL_MS = int(os.getenv("STATE_FLUSH_INTERVAL_MS", "500"))
+STATE_RESTORE_CONCURRENCY = int(os.getenv("STATE_RESTORE_CONCURRENCY", "4"))
+POSITION_CHECKPOINT_SECONDS = int(os.getenv("POSITION_CHECKPOINT_SECONDS", "15"))
+POSITION_REWIND_SECONDS = float(os.getenv("POSITION_REWIND_SECONDS", "2"))
+PEER_CACHE_TTL_SECONDS = int(os.getenv("PEER_CACHE_TTL_SECONDS", "86400"))
+PEER_WARMUP_PAGE_SIZE = int(os.getenv("PEER_WARMUP_PAGE_SIZE", "100"))
+PEER_WARMUP_PAUSE_SECONDS = float(os.getenv("PEER_WARMUP_PAUSE_SECONDS", "1"))
+PEER_WARMUP_MAX_DIALOGS = int(os.getenv("PEER_WARMUP_MAX_DIALOGS", "0"))
+PEER_WARMUP_WAIT_SECONDS = int(os.getenv("PEER_WARMUP_WAIT_SECONDS", "30"))
+
+if not API_ID or not API_HASH or not BOT_TOKEN:
+    raise RuntimeError("Set API_ID, API_HASH and BOT_TOKEN in environment variables.")
+
+Path(SESSION_DIR).mkdir(parents=True, exist_ok=True)
+
+
+def parse_privileged_users(raw: str) -> Set[int]:
+    result: Set[int] = set()
+    if not raw.strip():
+        return result
+    for chunk in raw.split(","):
+        item = chunk.strip()
+        if not item:
+            continue
+        try:
+            result.add(int(item))
+        except ValueError:
+            logger.warning("Ignored invalid user id in PRIVILEGED_USER_IDS: %s", item)
+    return result
+
+
+PRIVILEGED_USER_IDS = parse_privileged_users(PRIVILEGED_USER_IDS_RAW)
+
+
+def parse_session_names(raw: str) -> List[str]:
+    if raw.strip() == "*":
+        names = sorted(path.stem for path in Path(SESSION_DIR).glob("*.session"))
+        return names or [SESSION_NAME]
+    names = [chunk.strip() for chunk in raw.split(",") if chunk.strip()]
+    return names or [SESSION_NAME]
+
+
+SESSION_NAMES = parse_session_names(SESSION_NAMES_RAW)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._buckets = buckets
+        self._series: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0.0] * (len(self._buckets) + 2)
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            for i, bound in enumerate(self._buckets):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', str(bound)),))} {series[i]:g}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-2]:g}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-2]:g}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]:.6f}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(key)} {value:g}")
+        return lines
+
+
+class CallbackMetric:
+    def __init__(self, name: str, help_text: str, kind: str, func: Callable[[], float]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._kind = kind
+        self._func = func
+
+    def render(self) -> List[str]:
+        try:
+            value = float(self._func())
+        except Exception as exc:
+            logger.debug("Metric %s failed: %s", self.name, exc)
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self._kind}", f"{self.name} {value:g}"]
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: List[Any] = []
+
+    def histogram(
+        self, name: str, help_text: str, buckets: Tuple[float, ...] = Histogram.DEFAULT_BUCKETS
+    ) -> Histogram:
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        metric = Counter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge_func(self, name: str, help_text: str, func: Callable[[], float]) -> None:
+        self._metrics.append(CallbackMetric(name, help_text, "gauge", func))
+
+    def counter_func(self, name: str, help_text: str, func: Callable[[], float]) -> None:
+        self._metrics.append(CallbackMetric(name, help_text, "counter", func))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> None:
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                request_line = (await reader.readline()).decode("latin-1").split()
+                while (await reader.readline()).strip():
+                    pass
+                if len(request_line) > 1 and request_line[1].split("?")[0] == "/metrics":
+                    body = self.render().encode("utf-8")
+                    head = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                else:
+                    body = b"Not Found\n"
+                    head = "HTTP/1.1 404 Not Found\r\nContent-Type: text/plain\r\n"
+                writer.write(f"{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1"))
+                writer.write(body)
+                await writer.drain()
+            except Exception as exc:
+                logger.debug("Metrics request failed: %s", exc)
+            finally:
+                writer.close()
+
+        await asyncio.start_server(handle, host, port)
+        logger.info("Metrics endpoint on http://%s:%s/metrics", host, port)
+
+
+metrics = MetricsRegistry()
+SEARCH_SECONDS = metrics.histogram("tgstream_search_track_seconds", "Time to resolve a /play query into a track.")
+PEER_CHECK_SECONDS = metrics.histogram("tgstream_ensure_user_peer_seconds", "Time spent in ensure_user_peer.")
+CALLS_PLAY_SECONDS = metrics.histogram("tgstream_calls_play_seconds", "Time spent in calls.play.")
+TRACK_GAP_SECONDS = metrics.histogram(
+    "tgstream_track_gap_seconds", "Time from StreamAudioEnded to the next track playing."
+)
+RECONNECT_SECONDS = metrics.histogram("tgstream_reconnect_seconds", "Time from reconnect start to recovered playback.")
+RECONNECT_ATTEMPTS = metrics.counter("tgstream_reconnect_attempts_total", "Reconnect attempts by result.")
+PLAY_ERRORS = metrics.counter("tgstream_play_errors_total", "Playback errors by classifier.")
+LOOP_LAG_SECONDS = metrics.histogram(
+    "tgstream_event_loop_lag_seconds", "How late the event loop woke up for a timer.",
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_STALLS = metrics.counter("tgstream_event_loop_stalls_total", "Times the event loop was blocked past the threshold.")
+EXECUTOR_START_SECONDS = metrics.histogram(
+    "tgstream_executor_start_seconds", "Time for a no-op job to start in the loop's default thread pool."
+)
+REAPER_ACTIONS = metrics.counter("tgstream_reaper_actions_total", "Calls left and chats forgotten by the idle reaper.")
+
+
+class Tracer:
+    def __init__(self, path: str, sample_rate: float) -> None:
+        self._path = Path(path) if path else None
+        self._sample_rate = sample_rate
+        self._current: ContextVar[Optional[Dict[str, Any]]] = ContextVar("tgstream_span", default=None)
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        self.exported = 0
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+        if self._path is None:
+            yield attrs
+            return
+        parent = self._current.get()
+        if parent is None:
+            sampled = random.random() < self._sample_rate
+            trace_id = os.urandom(8).hex()
+        else:
+            sampled = parent["sampled"]
+            trace_id = parent["trace_id"]
+        span = {
+            "trace_id": trace_id,
+            "span_id": os.urandom(4).hex(),
+            "parent_id": parent["span_id"] if parent else None,
+            "sampled": sampled,
+        }
+        token = self._current.set(span)
+        started_at = time.time()
+        started = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except BaseException as exc:
+            error = exc.__class__.__name__
+            raise
+        finally:
+            self._current.reset(token)
+            if sampled:
+                record = {
+                    "trace_id": trace_id,
+                    "span_id": span["span_id"],
+                    "parent_id": span["parent_id"],
+                    "name": name,
+                    "start": round(started_at, 6),
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                    "attrs": attrs,
+                }
+                if error:
+                    record["error"] = error
+                self._export(record)
+
+    def _export(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._buffer.append(line)
+            self.exported += 1
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(1.0, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_timer = None
+            lines, self._buffer = self._buffer, []
+        if not lines or self._path is None:
+            return
+        with self._write_lock:
+            try:
+                self._path.parent.mkdir(parents=True, exist_ok=True)
+                with self._path.open("a", encoding="utf-8") as fh:
+                    fh.write("\n".join(lines) + "\n")
+            except Exception as exc:
+                logger.warning("Failed to write traces to %s: %s", self._path, exc)
+
+
+class Profiler:
+    def __init__(self, directory: str) -> None:
+        self._dir = Path(directory)
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, seconds: int) -> Optional["asyncio.Task[Path]"]:
+        if self.running:
+            return None
+        self._task = asyncio.create_task(self._run(seconds))
+        return self._task
+
+    async def _run(self, seconds: int) -> Path:
+        profile = cProfile.Profile()
+        logger.info("Profiling the event loop for %s s.", seconds)
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        path = self._dir / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.prof"
+        await asyncio.to_thread(self._dump, profile, path)
+        logger.info("Profile written to %s", path)
+        return path
+
+    @staticmethod
+    def _dump(profile: cProfile.Profile, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(str(path))
+        with path.with_suffix(".txt").open("w", encoding="utf-8") as fh:
+            pstats.Stats(profile, stream=fh).sort_stats("cumulative").print_stats(60)
+
+
+class LoopMonitor:
+    def __init__(self, interval: float, threshold: float, history: int) -> None:
+        self._interval = interval
+        self._threshold = threshold
+        self._lags: Deque[float] = deque(maxlen=600)
+        self._executor_waits: Deque[float] = deque(maxlen=120)
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._probe: Optional[asyncio.Task] = None
+        self._stalled_at: Optional[float] = None
+        self._stall_stack = ""
+        self.stalls: Deque[Tuple[float, float, str]] = deque(maxlen=max(1, history))
+        self.stall_count = 0
+        self.max_lag = 0.0
+        self.samples = 0
+        self.saturated_samples = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._interval > 0
+
+    def start(self) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._tick())
+        if self._threshold > 0:
+            threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _tick(self) -> None:
+        sample_every = max(1, round(1 / self._interval))
+        ticks = 0
+        while True:
+            expected = time.monotonic() + self._interval
+            await asyncio.sleep(self._interval)
+            self._beat = time.monotonic()
+            lag = max(0.0, self._beat - expected)
+            self._lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.observe(lag)
+            ticks += 1
+            if ticks % sample_every == 0:
+                self._sample_executors()
+
+    def _sample_executors(self) -> None:
+        self.samples += 1
+        if extraction_executor.running >= EXTRACT_WORKERS:
+            self.saturated_samples += 1
+        if self._probe is None or self._probe.done():
+            self._probe = asyncio.create_task(self._probe_default_executor())
+
+    async def _probe_default_executor(self) -> None:
+        submitted = time.perf_counter()
+        started = await asyncio.get_running_loop().run_in_executor(None, time.perf_counter)
+        wait = max(0.0, started - submitted)
+        self._executor_waits.append(wait)
+        EXECUTOR_START_SECONDS.observe(wait)
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(max(0.01, min(self._interval, self._threshold / 4)))
+            blocked = time.monotonic() - self._beat - self._interval
+            if blocked >= self._threshold and self._stalled_at is None:
+                self._stalled_at = self._beat
+                frame = sys._current_frames().get(self._loop_thread)
+                self._stall_stack = "".join(traceback.format_stack(frame, limit=30)) if frame else ""
+                logger.warning("Event loop blocked for %.2f s, loop thread stack:\n%s", blocked, self._stall_stack)
+            elif self._stalled_at is not None and self._beat > self._stalled_at:
+                duration = self._beat - self._stalled_at - self._interval
+                self.stall_count += 1
+                self.stalls.append((time.time(), duration, self._stall_stack))
+                LOOP_STALLS.inc()
+                logger.warning("Event loop resumed after being blocked for %.2f s.", duration)
+                self._stalled_at = None
+
+    def stats(self) -> Dict[str, float]:
+        lags = sorted(self._lags)
+        waits = list(self._executor_waits)
+        return {
+            "lag_p50": lags[len(lags) // 2] if lags else 0.0,
+            "lag_p99": lags[min(len(lags) - 1, int(len(lags) * 0.99))] if lags else 0.0,
+            "lag_max": self.max_lag,
+            "stalls": self.stall_count,
+            "extract_saturation": self.saturated_samples / self.samples if self.samples else 0.0,
+            "executor_wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "executor_wait_max": max(waits) if waits else 0.0,
+        }
+
+
+tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE)
+profiler = Profiler(PROFILE_DIR)
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL_MS / 1000, LOOP_STALL_THRESHOLD_MS / 1000, LOOP_STALL_HISTORY)
+
+
+def install_profile_signal() -> None:
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.start, PROFILE_SIGNAL_SECONDS)
+    except (NotImplementedError, RuntimeError) as exc:
+        logger.debug("SIGUSR1 profiling is unavailable: %s", exc)
+
+
+@dataclass(slots=True)
+class Track:
+    title: str
+    webpage_url: str
+    direct_url: str
+    duration: Optional[int]
+    requested_by: str
+
+
+def normalize_query(query: str) -> str:
+    text = " ".join(query.split())
+    if not text.lower().startswith(("http://", "https://")):
+        return text.lower()
+    parsed = urlparse(text)
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if host.startswith("m."):
+        host = host[2:]
+    video_id = ""
+    if host == "youtu.be":
+        video_id = parsed.path.strip("/")
+    elif host in ("youtube.com", "music.youtube.com") and parsed.path == "/watch":
+        video_id = parse_qs(parsed.query).get("v", [""])[0]
+    if video_id:
+        return f"https://www.youtube.com/watch?v={video_id}"
+    return text
+
+
+def stream_url_expiry(url: str) -> Optional[float]:
+    if not url:
+        return None
+    parsed = urlparse(url)
+    raw = parse_qs(parsed.query).get("expire", [""])[0]
+    if not raw:
+        parts = parsed.path.split("/")
+        if "expire" in parts:
+            idx = parts.index("expire")
+            raw = parts[idx + 1] if idx + 1 < len(parts) else ""
+    try:
+        return float(raw) if raw else None
+    except ValueError:
+        return None
+
+
+class TrackCache:
+    def __init__(self, max_size: int, default_ttl: int, margin: int, path: str = "") -> None:
+        self._max_size = max_size
+        self._default_ttl = default_ttl
+        self._margin = margin
+        self._path = Path(path) if path else None
+        self._entries: "OrderedDict[str, Tuple[float, Track]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer: Optional[threading.Timer] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._load()
+
+    def _expires_at(self, track: Track) -> float:
+        expiry = stream_url_expiry(track.direct_url)
+        if expiry is None:
+            return time.time() + self._default_ttl
+        return expiry - self._margin
+
+    def get(self, key: str) -> Optional[Track]:
+        if self._max_size <= 0 or not key:
+            return None
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, track = item
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return track
+
+    def put(self, keys: Iterable[str], track: Track) -> None:
+        if self._max_size <= 0:
+            return
+        expires_at = self._expires_at(track)
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            for key in keys:
+                if not key:
+                    continue
+                self._entries[key] = (expires_at, track)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            if self._path and self._save_timer is None:
+                self._save_timer = threading.Timer(5.0, self._save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            size = len(self._entries)
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _load(self) -> None:
+        if not self._path or not self._path.exists():
+            return
+        try:
+            raw = json.loads(self._path.read_text(encoding="utf-8"))
+        except Exception as exc:
+            logger.warning("Failed to load search cache from %s: %s", self._path, exc)
+            return
+        now = time.time()
+        for key, expires_at, data in raw:
+            if expires_at > now:
+                self._entries[key] = (expires_at, Track(**data))
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+        logger.info("Search cache loaded: %s entries.", len(self._entries))
+
+    def _save(self) -> None:
+        if not self._path:
+            return
+        with self._lock:
+            self._save_timer = None
+            snapshot = [[key, exp, asdict(track)] for key, (exp, track) in self._entries.items()]
+        with self._save_lock:
+            try:
+                self._path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self._path.with_suffix(self._path.suffix + ".tmp")
+                tmp_path.write_text(json.dumps(snapshot, ensure_ascii=False), encoding="utf-8")
+                os.replace(tmp_path, self._path)
+            except Exception as exc:
+                logger.warning("Failed to save search cache to %s: %s", self._path, exc)
+
+
+PRIORITY_NEXT = 0
+PRIORITY_DEEP = 1
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+class NodeBusy(Exception):
+    pass
+
+
+class TrackUnavailable(Exception):
+    pass
+
+
+class ExtractionExecutor:
+    def __init__(self, workers: int, mode: str, queue_limit: int, chat_queue_limit: int) -> None:
+        self._workers_count = max(1, workers)
+        self._mode = mode
+        self._queue_limit = queue_limit
+        self._chat_queue_limit = chat_queue_limit
+        self._pending: List["OrderedDict[int, Deque[tuple]]"] = [OrderedDict(), OrderedDict()]
+        self._chat_depth: Dict[int, int] = {}
+        self._tokens: Optional[asyncio.Queue] = None
+        self._pool: Optional[Executor] = None
+        self._workers: List[asyncio.Task] = []
+        self._wait_times: Deque[float] = deque(maxlen=256)
+        self.depth = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _ensure_started(self) -> None:
+        if self._pool is not None:
+            return
+        if self._mode == "process":
+            self._pool = ProcessPoolExecutor(max_workers=self._workers_count, initializer=prewarm_youtube_dl)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self._workers_count, thread_name_prefix="extract")
+            self._pool.submit(prewarm_youtube_dl)
+        self._tokens = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._workers_count)]
+        logger.info("Extraction executor started: mode=%s workers=%s", self._mode, self._workers_count)
+
+    async def submit(self, chat_id: int, priority: int, fn: Callable[..., Any], *args: Any) -> Any:
+        self._ensure_started()
+        chat_depth = self._chat_depth.get(chat_id, 0)
+        if self.depth >= self._queue_limit or chat_depth >= self._chat_queue_limit:
+            self.rejected += 1
+            raise ExecutorBusy("Extraction queue is full.")
+
+        future = asyncio.get_running_loop().create_future()
+        job = (future, fn, args, time.monotonic())
+        self._pending[priority].setdefault(chat_id, deque()).append(job)
+        self._chat_depth[chat_id] = chat_depth + 1
+        self.depth += 1
+        self._tokens.put_nowait(None)
+        return await future
+
+    def _next_job(self) -> Tuple[int, tuple]:
+        for chats in self._pending:
+            if not chats:
+                continue
+            chat_id, jobs = next(iter(chats.items()))
+            job = jobs.popleft()
+            if jobs:
+                chats.move_to_end(chat_id)
+            else:
+                del chats[chat_id]
+            return chat_id, job
+        raise RuntimeError("Extraction token without a pending job.")
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._tokens.get()
+            chat_id, (future, fn, args, enqueued_at) = self._next_job()
+            self.depth -= 1
+            if self._chat_depth[chat_id] <= 1:
+                del self._chat_depth[chat_id]
+            else:
+                self._chat_depth[chat_id] -= 1
+            if future.done():
+                continue
+
+            self._wait_times.append(time.monotonic() - enqueued_at)
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(self._pool, fn, *args)
+            except Exception as exc:
+                if not future.done():
+                    future.set_exception(exc)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.running -= 1
+                self.completed += 1
+
+    def stats(self) -> Dict[str, float]:
+        waits = list(self._wait_times)
+        return {
+            "depth": self.depth,
+            "depth_next": sum(len(jobs) for jobs in self._pending[PRIORITY_NEXT].values()),
+            "depth_deep": sum(len(jobs) for jobs in self._pending[PRIORITY_DEEP].values()),
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_max": max(waits) if waits else 0.0,
+        }
+
+
+SEARCH_YDL_OPTS = {
+    "format": "bestaudio[ext=m4a]/bestaudio/best",
+    "default_search": "ytsearch1",
+    "quiet": True,
+    "noplaylist": True,
+    "extract_flat": False,
+}
+
+
+PLAYLIST_YDL_OPTS = {
+    "quiet": True,
+    "extract_flat": "in_playlist",
+    "lazy_playlist": True,
+    "skip_download": True,
+}
+
+
+class YoutubeDLPool:
+    def __init__(self, opts: Dict[str, Any], size: int, recycle_after: int, max_age: int) -> None:
+        self._opts = opts
+        self._size = max(1, size)
+        self._recycle_after = recycle_after
+        self._max_age = max_age
+        self._idle: List[YoutubeDL] = []
+        self._meta: Dict[int, List[float]] = {}
+        self._cond = threading.Condition()
+        self._alive = 0
+        self.created = 0
+        self.recycled = 0
+
+    def _new(self) -> YoutubeDL:
+        ydl = YoutubeDL(dict(self._opts))
+        with self._cond:
+            self._meta[id(ydl)] = [time.monotonic(), 0]
+            self.created += 1
+        return ydl
+
+    def _acquire(self) -> YoutubeDL:
+        with self._cond:
+            while not self._idle and self._alive >= self._size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._alive += 1
+        try:
+            return self._new()
+        except Exception:
+            with self._cond:
+                self._alive -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, ydl: YoutubeDL) -> None:
+        with self._cond:
+            meta = self._meta[id(ydl)]
+            meta[1] += 1
+            expired = (
+                (self._recycle_after > 0 and meta[1] >= self._recycle_after)
+                or (self._max_age > 0 and time.monotonic() - meta[0] >= self._max_age)
+            )
+            if not expired:
+                self._idle.append(ydl)
+                self._cond.notify()
+                return
+            del self._meta[id(ydl)]
+            self._alive -= 1
+            self.recycled += 1
+            self._cond.notify()
+        close = getattr(ydl, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception as exc:
+                logger.debug("Failed to close recycled YoutubeDL: %s", exc)
+
+    @contextmanager
+    def checkout(self) -> Iterator[YoutubeDL]:
+        ydl = self._acquire()
+        try:
+            yield ydl
+        finally:
+            self._release(ydl)
+
+    def prewarm(self) -> None:
+        while True:
+            with self._cond:
+                if self._alive >= self._size:
+                    return
+                self._alive += 1
+            try:
+                ydl = self._new()
+            except Exception:
+                with self._cond:
+                    self._alive -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(ydl)
+                self._cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "alive": self._alive,
+                "idle": len(self._idle),
+                "created": self.created,
+                "recycled": self.recycled,
+            }
+
+
+def prewarm_youtube_dl() -> None:
+    try:
+        youtube_dl_pool.prewarm()
+    except Exception as exc:
+        logger.warning("Failed to prewarm YoutubeDL pool: %s", exc)
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AudioCache:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        min_plays: int,
+        max_track_seconds: int,
+        bitrate: str,
+    ) -> None:
+        self._dir = Path(directory)
+        self._max_bytes = max_bytes
+        self._min_plays = max(1, min_plays)
+        self._max_track_seconds = max_track_seconds
+        self._bitrate = bitrate
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._plays: "OrderedDict[str, int]" = OrderedDict()
+        self._filling: Set[str] = set()
+        self._fill_lock: Optional[asyncio.Lock] = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evictions = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_bytes > 0
+
+    def start(self) -> None:
+        # Called from startup rather than __init__: spawned extraction processes re-import this module.
+        if self.enabled:
+            self._scan()
+
+    def _scan(self) -> None:
+        self._dir.mkdir(parents=True, exist_ok=True)
+        for part in self._dir.glob("*.part"):
+            pid = part.suffixes[-2][1:] if len(part.suffixes) >= 2 else ""
+            # Fills write {key}.{pid}.part; another live process may still be writing its own.
+            if not pid.isdigit() or int(pid) == os.getpid() or not pid_alive(int(pid)):
+                part.unlink(missing_ok=True)
+        files = sorted(self._dir.glob("*.ogg"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            size = path.stat().st_size
+            self._index[path.stem] = size
+            self.total_bytes += size
+        self._evict()
+        logger.info("Audio cache: %s files, %.1f MB.", len(self._index), self.total_bytes / 1048576)
+
+    def _key(self, webpage_url: str) -> str:
+        return hashlib.sha1(normalize_query(webpage_url).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self._dir / f"{key}.ogg"
+
+    def lookup(self, webpage_url: str) -> Optional[str]:
+        if not self.enabled or not webpage_url:
+            return None
+        key = self._key(webpage_url)
+        path = self._path(key)
+        if key not in self._index or not path.exists():
+            self.misses += 1
+            return None
+        self._index.move_to_end(key)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return str(path.absolute())
+
+    def note_played(self, track: Track, url: str) -> None:
+        if not self.enabled or not track.webpage_url or not url.startswith(("http://", "https://")):
+            return
+        if track.duration and track.duration > self._max_track_seconds:
+            return
+        key = self._key(track.webpage_url)
+        if key in self._index or key in self._filling:
+            return
+        plays = self._plays.pop(key, 0) + 1
+        self._plays[key] = plays
+        while len(self._plays) > 4096:
+            self._plays.popitem(last=False)
+        if plays < self._min_plays:
+            return
+        self._filling.add(key)
+        asyncio.create_task(self._fill(key, url, track.title))
+
+    async def _fill(self, key: str, url: str, title: str) -> None:
+        if self._fill_lock is None:
+            self._fill_lock = asyncio.Lock()
+        part = self._dir / f"{key}.{os.getpid()}.part"
+        try:
+            async with self._fill_lock:
+                proc = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+                    "-i", url,
+                    "-vn", "-ac", "2", "-ar", "48000",
+                    "-c:a", "libopus", "-b:a", self._bitrate,
+                    "-f", "ogg", str(part),
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await proc.communicate()
+            if proc.returncode != 0:
+                self.failures += 1
+                logger.warning("Audio cache fill failed for %s: %s", title, stderr.decode(errors="ignore")[-300:])
+                part.unlink(missing_ok=True)
+                return
+            os.replace(part, self._path(key))
+            size = self._path(key).stat().st_size
+            self._index[key] = size
+            self.total_bytes += size
+            self._plays.pop(key, None)
+            self.stored += 1
+            self._evict()
+            logger.info("Audio cached: %s (%.1f MB)", title, size / 1048576)
+        except Exception as exc:
+            self.failures += 1
+            logger.warning("Audio cache fill failed for %s: %s", title, exc)
+            part.unlink(missing_ok=True)
+        finally:
+            self._filling.discard(key)
+
+    def _evict(self) -> None:
+        while self.total_bytes > self._max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._path(key).unlink(missing_ok=True)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "files": len(self._index),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stored": self.stored,
+            "evictions": self.evictions,
+            "failures": self.failures,
+        }
+
+
+class SharedStream:
+    CHUNK_SIZE = 64 * 1024
+    RANGE_SIZE = 10 * 1024 * 1024
+
+    def __init__(self, key: str, url: str, path: Path, loop: asyncio.AbstractEventLoop) -> None:
+        self.key = key
+        self.url = url
+        self.path = path
+        self.size = 0
+        self.total: Optional[int] = None
+        self.done = False
+        self.error: Optional[str] = None
+        self.readers = 0
+        self.last_used = time.monotonic()
+        self._loop = loop
+        self._changed = asyncio.Condition()
+        self._cancelled = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._download, name=f"proxy-{self.key[:8]}", daemon=True)
+            self._thread.start()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def _download(self) -> None:
+        error: Optional[str] = None
+        try:
+            with open(self.path, "wb") as out:
+                offset = 0
+                total: Optional[int] = None
+                while not self._cancelled.is_set():
+                    end = offset + self.RANGE_SIZE - 1
+                    request = Request(self.url, headers={"Range": f"bytes={offset}-{end}", "User-Agent": "Mozilla/5.0"})
+                    with urlopen(request, timeout=30) as response:
+                        content_range = response.headers.get("Content-Range", "")
+                        if "/" in content_range and content_range.rsplit("/", 1)[1].isdigit():
+                            total = int(content_range.rsplit("/", 1)[1])
+                            self._loop.call_soon_threadsafe(setattr, self, "total", total)
+                        ranged = response.status == 206
+                        received = 0
+                        while not self._cancelled.is_set():
+                            chunk = response.read(self.CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            out.write(chunk)
+                            out.flush()
+                            received += len(chunk)
+                            self._loop.call_soon_threadsafe(self._advance, len(chunk))
+                    offset += received
+                    if not ranged or received == 0 or (total is not None and offset >= total):
+                        break
+        except Exception as exc:
+            error = str(exc)
+        self._loop.call_soon_threadsafe(self._finish, error)
+
+    def _advance(self, count: int) -> None:
+        self.size += count
+        asyncio.ensure_future(self._notify())
+
+    def _finish(self, error: Optional[str]) -> None:
+        self.done = True
+        self.error = error
+        if error:
+            logger.warning("Stream proxy upstream failed for %s: %s", self.key[:8], error)
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def wait_beyond(self, offset: int) -> None:
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.size > offset or self.done)
+
+
+def probe_audio_file(path: str) -> Tuple[str, str, str, Optional[int]]:
+    try:
+        import mutagen
+    except ImportError:
+        mutagen = None
+    if mutagen is not None:
+        try:
+            audio = mutagen.File(path, easy=True)
+        except Exception as exc:
+            logger.debug("mutagen failed on %s: %s", path, exc)
+            audio = None
+        if audio is not None:
+            tags = audio.tags or {}
+
+            def tag(name: str) -> str:
+                value = tags.get(name) or [""]
+                return str(value[0]).strip()
+
+            length = getattr(audio.info, "length", None)
+            return tag("title"), tag("artist"), tag("album"), int(length) if length else None
+    try:
+        output = subprocess.run(
+            ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", path],
+            capture_output=True,
+            timeout=30,
+            check=True,
+        ).stdout
+        fmt = json.loads(output).get("format", {})
+    except Exception as exc:
+        logger.debug("ffprobe failed on %s: %s", path, exc)
+        return "", "", "", None
+    tags = {key.lower(): str(value).strip() for key, value in (fmt.get("tags") or {}).items()}
+    duration = fmt.get("duration")
+    try:
+        seconds = int(float(duration)) if duration else None
+    except ValueError:
+        seconds = None
+    return tags.get("title", ""), tags.get("artist", ""), tags.get("album", ""), seconds
+
+
+class LocalLibrary:
+    def __init__(self, root: str, db_path: str, workers: int, extensions: Set[str]) -> None:
+        self._root = Path(root).resolve() if root else None
+        self._db_path = db_path
+        self._workers = max(1, workers)
+        self._extensions = extensions
+        self._reader: Optional[sqlite3.Connection] = None
+        self._scan_lock = threading.Lock()
+        self.files = 0
+        self.scans = 0
+        self.probed = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._root is not None
+
+    def _connect(self) -> sqlite3.Connection:
+        Path(self._db_path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self._db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                album TEXT NOT NULL,
+                duration INTEGER
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                title, artist, album, name, tokenize = 'unicode61 remove_diacritics 2'
+            );
+            """
+        )
+        return conn
+
+    def scan(self) -> None:
+        if self._root is None:
+            return
+        with self._scan_lock:
+            started = time.monotonic()
+            conn = self._connect()
+            known = {path: (mtime, size) for path, mtime, size in conn.execute("SELECT path, mtime, size FROM files")}
+            seen: Set[str] = set()
+            changed: List[Tuple[str, float, int]] = []
+            for dirpath, _, filenames in os.walk(self._root):
+                for filename in filenames:
+                    if Path(filename).suffix.lower() not in self._extensions:
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    seen.add(path)
+                    if known.get(path) != (stat.st_mtime, stat.st_size):
+                        changed.append((path, stat.st_mtime, stat.st_size))
+            removed = [path for path in known if path not in seen]
+
+            with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="library") as pool:
+                probes = list(pool.map(lambda item: probe_audio_file(item[0]), changed))
+            with conn:
+                for path in removed:
+                    row = conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+                    if row:
+                        conn.execute("DELETE FROM files_fts WHERE rowid = ?", row)
+                        conn.execute("DELETE FROM files WHERE id = ?", row)
+                for (path, mtime, size), (title, artist, album, duration) in zip(changed, probes):
+                    name = Path(path).stem
+                    title = title or name
+                    row = conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+                    if row:
+                        conn.execute(
+                            "UPDATE files SET mtime = ?, size = ?, title = ?, artist = ?, album = ?, duration = ? "
+                            "WHERE id = ?",
+                            (mtime, size, title, artist, album, duration, row[0]),
+                        )
+                        conn.execute("DELETE FROM files_fts WHERE rowid = ?", row)
+                        file_id = row[0]
+                    else:
+                        file_id = conn.execute(
+                            "INSERT INTO files (path, mtime, size, title, artist, album, duration) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (path, mtime, size, title, artist, album, duration),
+                        ).lastrowid
+                    conn.execute(
+                        "INSERT INTO files_fts (rowid, title, artist, album, name) VALUES (?, ?, ?, ?, ?)",
+                        (file_id, title, artist, album, name),
+                    )
+            self.files = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            conn.close()
+            self.scans += 1
+            self.probed += len(changed)
+            logger.info(
+                "Library scanned in %.1fs: %s files, %s updated, %s removed.",
+                time.monotonic() - started,
+                self.files,
+                len(changed),
+                len(removed),
+            )
+
+    def search(self, query: str, requested_by: str) -> Optional[Track]:
+        if self._root is None or query.startswith(("http://", "https://")):
+            return None
+        tokens = re.findall(r"\w+", query.lower())
+        if not tokens:
+            return None
+        if self._reader is None:
+            self._reader = self._connect()
+        match = " ".join(f'"{token}"*' for token in tokens)
+        try:
+            row = self._reader.execute(
+                "SELECT f.path, f.title, f.artist, f.duration FROM files_fts "
+                "JOIN files f ON f.id = files_fts.rowid WHERE files_fts MATCH ? "
+                "ORDER BY bm25(files_fts) LIMIT 1",
+                (match,),
+            ).fetchone()
+        except sqlite3.Error as exc:
+            logger.debug("Library query failed for %r: %s", query, exc)
+            row = None
+        if row is None or not os.path.exists(row[0]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        path, title, artist, duration = row
+        display = f"{artist} - {title}" if artist else title
+        return Track(display, Path(path).as_uri(), path, duration, requested_by)
+
+    async def run(self, interval: int) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.scan)
+            except Exception as exc:
+                logger.warning("Library scan failed: %s", exc)
+            if interval <= 0:
+                return
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict[str, int]:
+        return {"files": self.files, "scans": self.scans, "probed": self.probed, "hits": self.hits, "misses": self.misses}
+
+
+def is_local_track(track: Track) -> bool:
+    return track.webpage_url.startswith("file:")
+
+
+class StreamProxy:
+    def __init__(self, host: str, port: int, directory: str, linger: int, max_track_seconds: int) -> None:
+        self._host = host
+        self._port = port
+        self._dir = Path(directory)
+        self._linger = linger
+        self._max_track_seconds = max_track_seconds
+        self._streams: Dict[str, SharedStream] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._janitor: Optional[asyncio.Task] = None
+        self.upstream_requests = 0
+        self.served = 0
+        self.bytes_served = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._port > 0
+
+    async def _ensure_started(self) -> None:
+        if self._server is not None:
+            return
+        self._dir.mkdir(parents=True, exist_ok=True)
+        for stale in self._dir.glob("*.spill"):
+            stale.unlink(missing_ok=True)
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        self._janitor = asyncio.create_task(self._cleanup_loop())
+        logger.info("Stream proxy listening on %s:%s", self._host, self._port)
+
+    async def url_for(self, track: Track) -> str:
+        if not self.enabled or not track.direct_url.startswith(("http://", "https://")):
+            return track.direct_url
+        if track.duration and track.duration > self._max_track_seconds:
+            return track.direct_url
+        await self._ensure_started()
+        key = hashlib.sha1(normalize_query(track.webpage_url or track.direct_url).encode("utf-8")).hexdigest()
+        stream = self._streams.get(key)
+        if stream is None or stream.error:
+            if stream is not None:
+                self._drop(stream)
+            stream = SharedStream(key, track.direct_url, self._dir / f"{key}.spill", asyncio.get_running_loop())
+            self._streams[key] = stream
+        stream.last_used = time.monotonic()
+        return f"http://{self._host}:{self._port}/s/{key}"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        stream: Optional[SharedStream] = None
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers: Dict[str, str] = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            key = request_line[1].rsplit("/", 1)[-1] if len(request_line) > 1 else ""
+            stream = self._streams.get(key)
+            if stream is None:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+
+            offset = 0
+            range_header = headers.get("range", "")
+            if range_header.startswith("bytes="):
+                start = range_header[6:].split("-", 1)[0]
+                offset = int(start) if start.isdigit() else 0
+
+            if stream._thread is None:
+                self.upstream_requests += 1
+                stream.start()
+            stream.readers += 1
+            self.served += 1
+            await stream.wait_beyond(0)
+            if stream.error and stream.size == 0:
+                writer.write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+
+            status = "206 Partial Content" if offset else "200 OK"
+            head = [f"HTTP/1.1 {status}", "Content-Type: application/octet-stream", "Connection: close"]
+            if stream.total is not None:
+                head.append("Accept-Ranges: bytes")
+                head.append(f"Content-Length: {stream.total - offset}")
+                if offset:
+                    head.append(f"Content-Range: bytes {offset}-{stream.total - 1}/{stream.total}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+
+            with open(stream.path, "rb") as source:
+                while True:
+                    if offset >= stream.size:
+                        if stream.done:
+                            break
+                        await stream.wait_beyond(offset)
+                        continue
+                    source.seek(offset)
+                    data = source.read(min(SharedStream.CHUNK_SIZE * 4, stream.size - offset))
+                    offset += len(data)
+                    self.bytes_served += len(data)
+                    writer.write(data)
+                    await writer.drain()
+                    stream.last_used = time.monotonic()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as exc:
+            logger.warning("Stream proxy reader failed: %s", exc)
+        finally:
+            if stream is not None and stream.readers > 0:
+                stream.readers -= 1
+                stream.last_used = time.monotonic()
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    def _drop(self, stream: SharedStream) -> None:
+        stream.cancel()
+        self._streams.pop(stream.key, None)
+        stream.path.unlink(missing_ok=True)
+
+    async def _cleanup_loop(self) -> None:
+        while True:
+            await asyncio.sleep(15)
+            now = time.monotonic()
+            for stream in list(self._streams.values()):
+                if stream.readers == 0 and now - stream.last_used > self._linger:
+                    self._drop(stream)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "streams": len(self._streams),
+            "readers": sum(stream.readers for stream in self._streams.values()),
+            "upstream_requests": self.upstream_requests,
+            "served": self.served,
+            "bytes_served": self.bytes_served,
+            "spill_bytes": sum(stream.size for stream in self._streams.values()),
+        }
+
+
+class TrackList:
+    BLOCK_SIZE = 128
+
+    __slots__ = ("_blocks", "_len")
+
+    def __init__(self, tracks: Iterable[Track] = ()) -> None:
+        self._blocks: Deque[Deque[Track]] = deque()
+        self._len = 0
+        self.extend(tracks)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Track]:
+        for block in self._blocks:
+            yield from block
+
+    def append(self, track: Track) -> None:
+        if not self._blocks or len(self._blocks[-1]) >= self.BLOCK_SIZE:
+            self._blocks.append(deque())
+        self._blocks[-1].append(track)
+        self._len += 1
+
+    def extend(self, tracks: Iterable[Track]) -> None:
+        for track in tracks:
+            self.append(track)
+
+    def popleft(self) -> Track:
+        block = self._blocks[0]
+        track = block.popleft()
+        if not block:
+            self._blocks.popleft()
+        self._len -= 1
+        return track
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        if not 0 <= index < self._len:
+            raise IndexError("track index out of range")
+        if index < self._len // 2:
+            for block_index, block in enumerate(self._blocks):
+                if index < len(block):
+                    return block_index, index
+                index -= len(block)
+        else:
+            index = self._len - 1 - index
+            for block_index in range(len(self._blocks) - 1, -1, -1):
+                block = self._blocks[block_index]
+                if index < len(block):
+                    return block_index, len(block) - 1 - index
+                index -= len(block)
+        raise IndexError("track index out of range")
+
+    def __getitem__(self, index: int) -> Track:
+        block_index, offset = self._locate(index)
+        return self._blocks[block_index][offset]
+
+    def pop_at(self, index: int) -> Track:
+        block_index, offset = self._locate(index)
+        block = self._blocks[block_index]
+        track = block[offset]
+        del block[offset]
+        self._len -= 1
+        if not block:
+            del self._blocks[block_index]
+        elif len(block) < self.BLOCK_SIZE // 2:
+            self._merge(block_index)
+        return track
+
+    def _merge(self, block_index: int) -> None:
+        for left in (block_index - 1, block_index):
+            if left < 0 or left + 1 >= len(self._blocks):
+                continue
+            if len(self._blocks[left]) + len(self._blocks[left + 1]) <= self.BLOCK_SIZE:
+                self._blocks[left].extend(self._blocks[left + 1])
+                del self._blocks[left + 1]
+                return
+
+    def insert(self, index: int, track: Track) -> None:
+        if index >= self._len:
+            self.append(track)
+            return
+        block_index, offset = self._locate(max(0, index))
+        block = self._blocks[block_index]
+        block.insert(offset, track)
+        self._len += 1
+        if len(block) > self.BLOCK_SIZE * 2:
+            tail: Deque[Track] = deque()
+            for _ in range(self.BLOCK_SIZE):
+                tail.appendleft(block.pop())
+            self._blocks.insert(block_index + 1, tail)
+
+    def slice(self, start: int, stop: int) -> List[Track]:
+        stop = min(stop, self._len)
+        if start >= stop:
+            return []
+        block_index, offset = self._locate(start)
+        result: List[Track] = []
+        while len(result) < stop - start:
+            block = self._blocks[block_index]
+            for i in range(offset, len(block)):
+                result.append(block[i])
+                if len(result) == stop - start:
+                    break
+            block_index += 1
+            offset = 0
+        return result
+
+
+class MusicQueue:
+    def __init__(self) -> None:
+        self._queues: Dict[int, TrackList] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._lock_users: Dict[int, int] = {}
+        self.on_change: Optional[Callable[[int], None]] = None
+
+    def _changed(self, chat_id: int) -> None:
+        if self.on_change is not None:
+            self.on_change(chat_id)
+
+    @asynccontextmanager
+    async def _locked(self, chat_id: int) -> AsyncIterator[TrackList]:
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._lock_users[chat_id] = self._lock_users.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                tracks = self._queues.get(chat_id)
+                if tracks is None:
+                    tracks = self._queues[chat_id] = TrackList()
+                yield tracks
+        finally:
+            users = self._lock_users[chat_id] - 1
+            if users:
+                self._lock_users[chat_id] = users
+            else:
+                del self._lock_users[chat_id]
+                del self._locks[chat_id]
+                if not self._queues.get(chat_id):
+                    self._queues.pop(chat_id, None)
+
+    async def push(self, chat_id: int, track: Track) -> int:
+        async with self._locked(chat_id) as tracks:
+            tracks.append(track)
+            self._changed(chat_id)
+            return len(tracks)
+
+    async def extend(self, chat_id: int, new_tracks: Iterable[Track]) -> int:
+        async with self._locked(chat_id) as tracks:
+            tracks.extend(new_tracks)
+            self._changed(chat_id)
+            return len(tracks)
+
+    async def pop(self, chat_id: int) -> Optional[Track]:
+        async with self._locked(chat_id) as tracks:
+            if not tracks:
+                return None
+            self._changed(chat_id)
+            return tracks.popleft()
+
+    async def remove(self, chat_id: int, index: int) -> Optional[Track]:
+        async with self._locked(chat_id) as tracks:
+            if not 0 <= index < len(tracks):
+                return None
+            self._changed(chat_id)
+            return tracks.pop_at(index)
+
+    async def move(self, chat_id: int, src: int, dst: int) -> Optional[Track]:
+        async with self._locked(chat_id) as tracks:
+            if not 0 <= src < len(tracks) or not 0 <= dst < len(tracks):
+                return None
+            track = tracks.pop_at(src)
+            tracks.insert(dst, track)
+            self._changed(chat_id)
+            return track
+
+    async def clear(self, chat_id: int) -> None:
+        async with self._locked(chat_id):
+            self._queues[chat_id] = TrackList()
+            self._changed(chat_id)
+
+    async def list(self, chat_id: int) -> List[Track]:
+        async with self._locked(chat_id) as tracks:
+            return list(tracks)
+
+    async def page(self, chat_id: int, offset: int, limit: int) -> Tuple[List[Track], int]:
+        async with self._locked(chat_id) as tracks:
+            return tracks.slice(offset, offset + limit), len(tracks)
+
+    async def size(self, chat_id: int) -> int:
+        tracks = self._queues.get(chat_id)
+        return len(tracks) if tracks else 0
+
+    async def get(self, chat_id: int, index: int) -> Optional[Track]:
+        async with self._locked(chat_id) as tracks:
+            return tracks[index] if 0 <= index < len(tracks) else None
+
+    async def peek(self, chat_id: int) -> Optional[Track]:
+        return await self.get(chat_id, 0)
+
+    def chat_ids(self) -> List[int]:
+        return list(self._queues)
+
+    def forget(self, chat_id: int) -> None:
+        self._queues.pop(chat_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chats": len(self._queues),
+            "tracks": sum(len(tracks) for tracks in self._queues.values()),
+            "locks": len(self._locks),
+        }
+
+
+class StateStore:
+    def __init__(self, path: str, flush_interval: float) -> None:
+        self._path = path
+        self._flush_interval = flush_interval
+        self._dirty: Set[int] = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._path)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self._path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS chats (
+                    chat_id INTEGER PRIMARY KEY,
+                    active INTEGER NOT NULL,
+                    paused INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS tracks (
+                    chat_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    webpage_url TEXT NOT NULL,
+                    direct_url TEXT NOT NULL,
+                    duration INTEGER,
+                    requested_by TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, position)
+                );
+                CREATE TABLE IF NOT EXISTS peers (
+                    session TEXT NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    verified_at REAL NOT NULL,
+                    PRIMARY KEY (session, chat_id)
+                );
+                CREATE TABLE IF NOT EXISTS positions (
+                    chat_id INTEGER PRIMARY KEY,
+                    webpage_url TEXT NOT NULL,
+                    offset REAL NOT NULL,
+                    saved_at REAL NOT NULL
+                );
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def mark_dirty(self, chat_id: int) -> None:
+        if not self.enabled:
+            return
+        self._dirty.add(chat_id)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        # A flush that is already writing has swapped out _dirty, so chats marked meanwhile need a new timer.
+        if self._flusher is None or self._flusher.done() or self._flusher is asyncio.current_task():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._flush_interval)
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            batch = []
+            for chat_id in dirty:
+                tracks = await queue.list(chat_id)
+                batch.append(
+                    (
+                        chat_id,
+                        bool(active_calls.get(chat_id)),
+                        chat_id in paused_calls,
+                        [
+                            (chat_id, pos, t.title, t.webpage_url, t.direct_url, t.duration, t.requested_by)
+                            for pos, t in enumerate(tracks)
+                        ],
+                    )
+                )
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._write, batch)
+        except Exception as exc:
+            logger.warning("Failed to persist state for %s chats: %s", len(dirty), exc)
+            self._dirty |= dirty
+        finally:
+            if self._dirty:
+                self._schedule_flush()
+
+    def _write(self, batch: List[tuple]) -> None:
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            for chat_id, active, paused, rows in batch:
+                conn.execute("DELETE FROM tracks WHERE chat_id = ?", (chat_id,))
+                if not active and not rows:
+                    conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+                    continue
+                conn.execute(
+                    "INSERT OR REPLACE INTO chats (chat_id, active, paused, updated_at) VALUES (?, ?, ?, ?)",
+                    (chat_id, int(active), int(paused), now),
+                )
+                conn.executemany("INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                self.rows_written += len(rows)
+        self.flushes += 1
+
+    def _read(self) -> Dict[int, Tuple[bool, bool, List[Track]]]:
+        conn = self._connect()
+        result: Dict[int, Tuple[bool, bool, List[Track]]] = {}
+        for chat_id, active, paused in conn.execute("SELECT chat_id, active, paused FROM chats"):
+            result[chat_id] = (bool(active), bool(paused), [])
+        rows = conn.execute(
+            "SELECT chat_id, title, webpage_url, direct_url, duration, requested_by "
+            "FROM tracks ORDER BY chat_id, position"
+        )
+        for chat_id, title, webpage_url, direct_url, duration, requested_by in rows:
+            if chat_id in result:
+                result[chat_id][2].append(Track(title, webpage_url, direct_url, duration, requested_by))
+        return result
+
+    async def load(self) -> Dict[int, Tuple[bool, bool, List[Track]]]:
+        if not self.enabled:
+            return {}
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._read)
+
+    def _write_peers(self, upserts: List[Tuple[str, int, float]], deletes: List[Tuple[str, int]]) -> None:
+        conn = self._connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO peers VALUES (?, ?, ?)", upserts)
+            conn.executemany("DELETE FROM peers WHERE session = ? AND chat_id = ?", deletes)
+
+    async def write_peers(self, upserts: List[Tuple[str, int, float]], deletes: List[Tuple[str, int]]) -> None:
+        if not self.enabled:
+            return
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write_peers, upserts, deletes)
+
+    def _read_peers(self) -> List[Tuple[str, int, float]]:
+        return list(self._connect().execute("SELECT session, chat_id, verified_at FROM peers"))
+
+    async def load_peers(self) -> List[Tuple[str, int, float]]:
+        if not self.enabled:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._read_peers)
+
+    def _write_positions(self, upserts: List[Tuple[int, str, float, float]], deletes: List[int]) -> None:
+        conn = self._connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?)", upserts)
+            conn.executemany("DELETE FROM positions WHERE chat_id = ?", [(chat_id,) for chat_id in deletes])
+
+    async def write_positions(self, upserts: List[Tuple[int, str, float, float]], deletes: List[int]) -> None:
+        if not self.enabled:
+            return
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write_positions, upserts, deletes)
+
+    def _read_positions(self) -> Dict[int, Tuple[str, float]]:
+        rows = self._connect().execute("SELECT chat_id, webpage_url, offset FROM positions")
+        return {chat_id: (webpage_url, offset) for chat_id, webpage_url, offset in rows}
+
+    async def load_positions(self) -> Dict[int, Tuple[str, float]]:
+        if not self.enabled:
+            return {}
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._read_positions)
+
+    def stats(self) -> Dict[str, int]:
+        return {"dirty": len(self._dirty), "flushes": self.flushes, "rows_written": self.rows_written}
+
+
+class PeerCache:
+    def __init__(self, store: StateStore, ttl: int) -> None:
+        self._store = store
+        self._ttl = ttl
+        self._verified: Dict[Tuple[str, int], float] = {}
+        self._pending: Dict[Tuple[str, int], Optional[float]] = {}
+        self._warm: Dict[str, asyncio.Event] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.warmed = 0
+
+    def verified(self, session: str, chat_id: int) -> bool:
+        verified_at = self._verified.get((session, chat_id))
+        if verified_at is not None and time.time() - verified_at < self._ttl:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def mark(self, session: str, chat_id: int) -> None:
+        now = time.time()
+        self._verified[(session, chat_id)] = now
+        self._pending[(session, chat_id)] = now
+        self._schedule_flush()
+
+    def invalidate(self, session: str, chat_id: int) -> None:
+        if self._verified.pop((session, chat_id), None) is not None:
+            self._pending[(session, chat_id)] = None
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flusher is None or self._flusher.done() or self._flusher is asyncio.current_task():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(5)
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        upserts = [(session, chat_id, at) for (session, chat_id), at in pending.items() if at is not None]
+        deletes = [key for key, at in pending.items() if at is None]
+        try:
+            await self._store.write_peers(upserts, deletes)
+        except Exception as exc:
+            logger.warning("Failed to persist peer cache: %s", exc)
+            for key, at in pending.items():
+                self._pending.setdefault(key, at)
+        finally:
+            if self._pending:
+                self._schedule_flush()
+
+    async def start(self, shards: List["Shard"]) -> None:
+        try:
+            rows = await self._store.load_peers()
+        except Exception as exc:
+            logger.warning("Failed to load peer cache: %s", exc)
+            rows = []
+        cutoff = time.time() - self._ttl
+        for session, chat_id, verified_at in rows:
+            if verified_at > cutoff:
+                self._verified[(session, chat_id)] = verified_at
+        logger.info("Peer cache loaded: %s entries.", len(self._verified))
+        for shard in shards:
+            self._warm[shard.name] = asyncio.Event()
+            asyncio.create_task(self._warmup(shard))
+
+    async def _warmup(self, shard: "Shard") -> None:
+        seen = 0
+        try:
+            for _ in range(3):
+                try:
+                    async for dialog in shard.user.get_dialogs():
+                        self.mark(shard.name, dialog.chat.id)
+                        seen += 1
+                        self.warmed += 1
+                        if PEER_WARMUP_MAX_DIALOGS and seen >= PEER_WARMUP_MAX_DIALOGS:
+                            break
+                        if seen % max(1, PEER_WARMUP_PAGE_SIZE) == 0:
+                            await asyncio.sleep(PEER_WARMUP_PAUSE_SECONDS)
+                    break
+                except FloodWait as exc:
+                    logger.warning("Dialog warmup for %s hit FloodWait, sleeping %s s.", shard.name, exc.value)
+                    await asyncio.sleep(exc.value)
+            logger.info("Dialogs warmed for session %s: %s.", shard.name, seen)
+        except Exception as exc:
+            logger.warning("Failed to warm dialogs for session %s: %s", shard.name, exc)
+        finally:
+            self._warm[shard.name].set()
+
+    async def wait_warm(self, session: str, timeout: float) -> bool:
+        event = self._warm.get(session)
+        if event is None or event.is_set():
+            return False
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        warming = sum(1 for event in self._warm.values() if not event.is_set())
+        return {
+            "size": len(self._verified),
+            "hits": self.hits,
+            "misses": self.misses,
+            "warmed": self.warmed,
+            "warming": warming,
+        }
+
+
+class ReconnectScheduler:
+    def __init__(self, concurrency: int, rate: float, burst: int) -> None:
+        self._concurrency = max(1, concurrency)
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[Tuple[int, int], int, "asyncio.Future[None]"]] = []
+        self._seq = 0
+        self._running = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.attempts = 0
+        self.recovered = 0
+        self.gave_up = 0
+        self.breaker_trips = 0
+
+    @asynccontextmanager
+    async def slot(self, priority: Tuple[int, int]) -> AsyncIterator[None]:
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        self.attempts += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning("Reconnects paused for %s s.", seconds)
+
+    def _release(self) -> None:
+        self._running -= 1
+        self._dispatch()
+
+    def _refill(self, now: float) -> None:
+        if self._rate > 0:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        else:
+            self._tokens = float(self._burst)
+        self._updated = now
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters and self._running < self._concurrency:
+            if self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+                continue
+            if now < self._paused_until or self._tokens < 1:
+                break
+            _, _, future = heapq.heappop(self._waiters)
+            self._tokens -= 1
+            self._running += 1
+            future.set_result(None)
+        if self._waiters and self._running < self._concurrency and self._timer is None:
+            delay = max(self._paused_until - now, (1 - self._tokens) / self._rate if self._rate > 0 else 0, 0.01)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "waiting": sum(1 for _, _, future in self._waiters if not future.done()),
+            "running": self._running,
+            "attempts": self.attempts,
+            "recovered": self.recovered,
+            "gave_up": self.gave_up,
+            "breaker_trips": self.breaker_trips,
+        }
+
+
+class Outbox:
+    MAX_RETRIES = 3
+
+    def __init__(self, rate: float, chat_interval: float, chat_limit: int) -> None:
+        self._rate = max(0.1, rate)
+        self._chat_interval = chat_interval
+        self._chat_limit = max(1, chat_limit)
+        self._tokens = self._rate
+        self._updated = time.monotonic()
+        self._pending: "OrderedDict[int, OrderedDict[str, Tuple[str, int]]]" = OrderedDict()
+        self._next_at: Dict[int, float] = {}
+        self._sending: Set[int] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._bot: Any = None
+        self._seq = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.flood_waits = 0
+        self.failed = 0
+
+    def send(self, bot: Any, chat_id: int, text: str, key: Optional[str] = None) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            asyncio.create_task(self._run())
+        self._bot = bot
+        messages = self._pending.setdefault(chat_id, OrderedDict())
+        if key is None:
+            self._seq += 1
+            key = f"#{self._seq}"
+        elif key in messages:
+            self.coalesced += 1
+            del messages[key]
+        messages[key] = (text, 0)
+        while len(messages) > self._chat_limit:
+            messages.popitem(last=False)
+            self.dropped += 1
+        self._wakeup.set()
+
+    def _next_chat(self, now: float) -> Optional[int]:
+        for chat_id in self._pending:
+            if chat_id not in self._sending and self._next_at.get(chat_id, 0) <= now:
+                return chat_id
+        return None
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            chat_id = self._next_chat(now) if self._tokens >= 1 else None
+            if chat_id is None:
+                self._wakeup.clear()
+                if not self._pending:
+                    self._next_at = {c: at for c, at in self._next_at.items() if at > now}
+                waits = [self._next_at.get(c, 0) - now for c in self._pending if c not in self._sending]
+                if self._tokens < 1:
+                    waits = [max(w, (1 - self._tokens) / self._rate) for w in waits]
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(0.01, min(waits)) if waits else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            messages = self._pending[chat_id]
+            key, (text, retries) = messages.popitem(last=False)
+            if messages:
+                self._pending.move_to_end(chat_id)
+            else:
+                del self._pending[chat_id]
+            self._tokens -= 1
+            self._next_at[chat_id] = now + self._chat_interval
+            self._sending.add(chat_id)
+            asyncio.create_task(self._deliver(chat_id, key, text, retries))
+
+    async def _deliver(self, chat_id: int, key: str, text: str, retries: int) -> None:
+        try:
+            await self._bot.send_message(chat_id, text)
+            self.sent += 1
+        except FloodWait as exc:
+            self.flood_waits += 1
+            self._next_at[chat_id] = time.monotonic() + exc.value
+            if retries < self.MAX_RETRIES:
+                messages = self._pending.setdefault(chat_id, OrderedDict())
+                if key not in messages:
+                    messages[key] = (text, retries + 1)
+                    messages.move_to_end(key, last=False)
+            logger.warning("FloodWait %s s while notifying chat %s.", exc.value, chat_id)
+        except Exception as exc:
+            self.failed += 1
+            logger.warning("Failed to send message to %s: %s", chat_id, exc)
+        finally:
+            self._sending.discard(chat_id)
+            self._wakeup.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": sum(len(messages) for messages in self._pending.values()),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "flood_waits": self.flood_waits,
+            "failed": self.failed,
+        }
+
+
+def available_memory_mb() -> Optional[int]:
+    try:
+        with open("/proc/meminfo", encoding="ascii") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        return None
+    return None
+
+
+class NodeAdmission:
+    def __init__(self, max_streams: int, max_load: float, min_free_mb: int, waitlist: bool) -> None:
+        self._max_streams = max_streams
+        self._max_load = max_load
+        self._min_free_mb = min_free_mb
+        self.waitlist_enabled = waitlist
+        self._starting: Set[int] = set()
+        self._waitlist: "OrderedDict[int, Tuple[PyTgCalls, Client, Client]]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self.rejected = 0
+        self.waitlisted = 0
+        self.promoted = 0
+
+    def in_use(self) -> int:
+        active = {chat_id for chat_id, on in active_calls.items() if on}
+        return len(active | self._starting)
+
+    def full_reason(self) -> Optional[str]:
+        if self._max_streams > 0 and self.in_use() >= self._max_streams:
+            return f"заняты все {self._max_streams} слотов"
+        if self._max_load > 0 and hasattr(os, "getloadavg"):
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if load >= self._max_load:
+                return f"нагрузка CPU {load:.2f}"
+        if self._min_free_mb > 0:
+            free = available_memory_mb()
+            if free is not None and free < self._min_free_mb:
+                return f"свободно памяти {free} МБ"
+        return None
+
+    @contextmanager
+    def starting(self, chat_id: int) -> Iterator[None]:
+        self._starting.add(chat_id)
+        try:
+            yield
+        finally:
+            self._starting.discard(chat_id)
+
+    def waitlist(self, chat_id: int, calls: PyTgCalls, bot: Client, user: Client) -> int:
+        if chat_id not in self._waitlist:
+            self.waitlisted += 1
+        self._waitlist[chat_id] = (calls, bot, user)
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            asyncio.create_task(self._promote_loop())
+        return list(self._waitlist).index(chat_id) + 1
 
-if not API_ID or not API_HASH or not BOT_TOKEN:
-    raise RuntimeError("Set API_ID, API_HASH and BOT_TOKEN in environment variables.")
+    def discard(self, chat_id: int) -> None:
+        self._waitlist.pop(chat_id, None)
 
-Path(SESSION_DIR).mkdir(parents=True, exist_ok=True)
+    def busy(self, chat_id: int) -> bool:
+        return chat_id in self._starting or chat_id in self._waitlist
 
+    def kick(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
 
-def parse_privileged_users(raw: str) -> Set[int]:
-    result: Set[int] = set()
-    if not raw.strip():
-        return result
-    for chunk in raw.split(","):
-        item = chunk.strip()
-        if not item:
-            continue
-        try:
-            result.add(int(item))
-        except ValueError:
-            logger.warning("Ignored invalid user id in PRIVILEGED_USER_IDS: %s", item)
-    return result
+    async def _promote_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._waitlist and self.full_reason() is None:
+                chat_id, (calls, bot, user) = self._waitlist.popitem(last=False)
+                try:
+                    await self._promote(chat_id, calls, bot, user)
+                except Exception as exc:
+                    logger.warning("Failed to start waitlisted chat %s: %s", chat_id, exc)
 
+    async def _promote(self, chat_id: int, calls: PyTgCalls, bot: Client, user: Client) -> None:
+        if active_calls.get(chat_id) or not await queue.size(chat_id):
+            return
+        self.promoted += 1
+        with self.starting(chat_id):
+            status = await start_playback(chat_id, calls, bot, user)
+        notify(bot, chat_id, status, "track")
 
-PRIVILEGED_USER_IDS = parse_privileged_users(PRIVILEGED_USER_IDS_RAW)
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_use": self.in_use(),
+            "limit": self._max_streams,
+            "waitlist": len(self._waitlist),
+            "rejected": self.rejected,
+            "waitlisted": self.waitlisted,
+            "promoted": self.promoted,
+        }
 
 
-@dataclass
-class Track:
-    title: str
-    webpage_url: str
-    direct_url: str
-    duration: Optional[int]
-    requested_by: str
+def ffmpeg_parameters() -> str:
+    params = []
+    if FFMPEG_THREADS > 0:
+        params.append(f"-threads {FFMPEG_THREADS}")
+    if FFMPEG_QUEUE_SIZE > 0:
+        params.append(f"-thread_queue_size {FFMPEG_QUEUE_SIZE}")
+    if FFMPEG_EXTRA_ARGS:
+        params.append(FFMPEG_EXTRA_ARGS)
+    return " ".join(params)
 
 
-class MusicQueue:
-    def __init__(self) -> None:
-        self._queues: Dict[int, List[Track]] = {}
-        self._locks: Dict[int, asyncio.Lock] = {}
+def build_stream(source: str, offset: float = 0.0) -> Any:
+    params = ffmpeg_parameters()
+    if offset >= 1:
+        params = f"-ss {offset:.1f} {params}".strip()
+    if AudioPiped is not None:
+        return AudioPiped(source, additional_ffmpeg_parameters=params) if params else AudioPiped(source)
+    if MediaStream is not None:
+        kwargs: Dict[str, Any] = {}
+        ignore_video = getattr(getattr(MediaStream, "Flags", MediaStream), "IGNORE", None)
+        if ignore_video is not None:
+            kwargs["video_flags"] = ignore_video
+        if params:
+            kwargs["ffmpeg_parameters"] = params
+        return MediaStream(source, **kwargs)
+    return source
 
-    def _get_lock(self, chat_id: int) -> asyncio.Lock:
-        if chat_id not in self._locks:
-            self._locks[chat_id] = asyncio.Lock()
-        return self._locks[chat_id]
 
-    async def push(self, chat_id: int, track: Track) -> int:
-        async with self._get_lock(chat_id):
-            self._queues.setdefault(chat_id, []).append(track)
-            return len(self._queues[chat_id])
+reniced_ffmpeg: Set[int] = set()
 
-    async def pop(self, chat_id: int) -> Optional[Track]:
-        async with self._get_lock(chat_id):
-            queue = self._queues.get(chat_id, [])
-            if not queue:
-                return None
-            return queue.pop(0)
 
-    async def clear(self, chat_id: int) -> None:
-        async with self._get_lock(chat_id):
-            self._queues[chat_id] = []
+def renice_ffmpeg_children() -> None:
+    parent = str(os.getpid())
+    alive: Set[int] = set()
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        comm_end = stat.rfind(")")
+        comm = stat[stat.find("(") + 1:comm_end]
+        ppid = stat[comm_end + 2:].split()[1]
+        if ppid != parent or comm != "ffmpeg":
+            continue
+        pid = int(entry.name)
+        alive.add(pid)
+        if pid in reniced_ffmpeg:
+            continue
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, FFMPEG_NICE)
+        except OSError as exc:
+            logger.debug("Failed to renice ffmpeg %s: %s", pid, exc)
+    reniced_ffmpeg.intersection_update(alive)
+    reniced_ffmpeg.update(alive)
 
-    async def list(self, chat_id: int) -> List[Track]:
-        async with self._get_lock(chat_id):
-            return list(self._queues.get(chat_id, []))
 
-    async def peek(self, chat_id: int) -> Optional[Track]:
-        async with self._get_lock(chat_id):
-            queue = self._queues.get(chat_id, [])
-            return queue[0] if queue else None
+def notify(bot: Client, chat_id: int, text: str, key: Optional[str] = None) -> None:
+    forward = getattr(bot, "forward_notification", None)
+    if forward is not None:
+        forward(chat_id, text, key)
+    else:
+        outbox.send(bot, chat_id, text, key)
+
+
+def reconnect_backoff(failures: int) -> float:
+    delay = min(RECONNECT_MAX_DELAY_SECONDS, RECONNECT_DELAY_SECONDS * 2 ** max(0, failures - 1))
+    return random.uniform(delay / 2, delay)
 
 
 queue = MusicQueue()
+state_store = StateStore(STATE_DB, STATE_FLUSH_INTERVAL_MS / 1000)
+queue.on_change = state_store.mark_dirty
+peer_cache = PeerCache(state_store, PEER_CACHE_TTL_SECONDS)
+reconnect_scheduler = ReconnectScheduler(RECONNECT_CONCURRENCY, RECONNECT_RATE_PER_SECOND, RECONNECT_BURST)
+outbox = Outbox(OUTBOX_RATE_PER_SECOND, OUTBOX_CHAT_INTERVAL_SECONDS, OUTBOX_CHAT_LIMIT)
+admission = NodeAdmission(NODE_MAX_STREAMS, NODE_MAX_LOAD, NODE_MIN_FREE_MB, NODE_WAITLIST)
+session_pool: Optional["SessionPool"] = None
+metrics.gauge_func(
+    "tgstream_active_calls", "Chats with an active call.", lambda: sum(1 for v in active_calls.values() if v)
+)
+metrics.gauge_func("tgstream_stream_slots_in_use", "Stream slots in use on this node.", lambda: admission.in_use())
+metrics.gauge_func("tgstream_stream_waitlist", "Chats waiting for a stream slot.", lambda: admission.stats()["waitlist"])
+metrics.gauge_func("tgstream_paused_calls", "Chats with a paused call.", lambda: len(paused_calls))
+metrics.gauge_func("tgstream_tracked_chats", "Chats with in-memory state.", lambda: reaper.stats()["tracked"])
+metrics.gauge_func("tgstream_queue_tracks", "Tracks queued across all chats.", lambda: queue.stats()["tracks"])
+metrics.gauge_func(
+    "tgstream_reconnect_tasks", "Running reconnect tasks.", lambda: sum(1 for t in reconnect_tasks.values() if not t.done())
+)
+metrics.gauge_func(
+    "tgstream_reconnect_waiting", "Reconnects waiting for a join slot.", lambda: reconnect_scheduler.stats()["waiting"]
+)
+metrics.gauge_func("tgstream_executor_queue_depth", "Pending extraction jobs.", lambda: extraction_executor.depth)
+metrics.gauge_func("tgstream_executor_running", "Running extraction jobs.", lambda: extraction_executor.running)
+metrics.counter_func("tgstream_executor_rejected_total", "Rejected extraction jobs.", lambda: extraction_executor.rejected)
+metrics.counter_func("tgstream_search_cache_hits_total", "Search cache hits.", lambda: search_cache.hits)
+metrics.counter_func("tgstream_search_cache_misses_total", "Search cache misses.", lambda: search_cache.misses)
+metrics.counter_func("tgstream_audio_cache_hits_total", "Audio cache hits.", lambda: audio_cache.hits)
+metrics.counter_func(
+    "tgstream_proxy_upstream_requests_total", "Upstream downloads started by the stream proxy.",
+    lambda: stream_proxy.upstream_requests,
+)
 current_track: Dict[int, Track] = {}
 active_calls: Dict[int, bool] = {}
 reconnect_tasks: Dict[int, asyncio.Task] = {}
+prefetch_tasks: Dict[int, asyncio.Task] = {}
+track_ended_at: Dict[int, float] = {}
 paused_calls: Set[int] = set()
+search_cache = TrackCache(
+    SEARCH_CACHE_SIZE,
+    SEARCH_CACHE_TTL_SECONDS,
+    SEARCH_CACHE_EXPIRY_MARGIN_SECONDS,
+    SEARCH_CACHE_FILE,
+)
+extraction_executor = ExtractionExecutor(
+    EXTRACT_WORKERS,
+    EXTRACT_EXECUTOR,
+    EXTRACT_QUEUE_LIMIT,
+    EXTRACT_CHAT_QUEUE_LIMIT,
+)
+audio_cache = AudioCache(
+    AUDIO_CACHE_DIR,
+    AUDIO_CACHE_MAX_MB * 1024 * 1024,
+    AUDIO_CACHE_MIN_PLAYS,
+    AUDIO_CACHE_MAX_TRACK_SECONDS,
+    AUDIO_CACHE_BITRATE,
+)
+stream_proxy = StreamProxy(
+    STREAM_PROXY_HOST,
+    STREAM_PROXY_PORT,
+    STREAM_PROXY_DIR,
+    STREAM_PROXY_LINGER_SECONDS,
+    STREAM_PROXY_MAX_TRACK_SECONDS,
+)
+library = LocalLibrary(LIBRARY_DIR, LIBRARY_DB, LIBRARY_SCAN_WORKERS, LIBRARY_EXTENSIONS)
+youtube_dl_pool = YoutubeDLPool(SEARCH_YDL_OPTS, YTDL_POOL_SIZE, YTDL_RECYCLE_AFTER, YTDL_MAX_AGE_SECONDS)
+playlist_dl_pool = YoutubeDLPool(PLAYLIST_YDL_OPTS, 2, YTDL_RECYCLE_AFTER, YTDL_MAX_AGE_SECONDS)
+inflight_searches: Dict[str, "asyncio.Future[Track]"] = {}
+search_results: Dict[int, Tuple[float, List[Track], int]] = {}
+coalesced_searches = 0
 
 
 HELP_TEXT = (
     "Музыкальный бот готов.\n"
     "Команды:\n"
-    "/play <название>\n"
+    "/play <название или ссылка на плейлист>\n"
+    "/search <запрос>\n"
+    "/pick <номер>\n"
     "/pause\n"
     "/resume\n"
     "/skip\n"
-    "/queue\n"
+    "/queue [страница]\n"
+    "/remove <номер>\n"
+    "/move <откуда> <куда>\n"
     "/stop\n"
     "/reconnect\n"
     "/now\n"
     "/ping\n"
+    "/stats\n"
+    "/profile [секунды]\n"
+    "/loop\n"
     "/POMOGITE\n\n"
-    "Пропуск (/skip) и /reconnect доступны только администраторам или ID из PRIVILEGED_USER_IDS."
+    "Пропуск (/skip), /remove, /move, /reconnect, /stats, /profile и /loop доступны только администраторам или ID из PRIVILEGED_USER_IDS."
 )
 
 
@@ -165,6 +2499,7 @@ def is_peer_invalid_error(exc: Exception) -> bool:
     msg = str(exc).lower()
     return (
         "peer id invalid" in msg
+        or "peer_id_invalid" in msg
         or "channel private" in msg
         or "channel_private" in msg
         or "chat id invalid" in msg
@@ -186,9 +2521,43 @@ def is_voice_chat_missing(exc: Exception) -> bool:
         or "voice chat not found" in msg
         or "voice chat not started" in msg
         or "groupcall_not_found" in msg
+        or "no active group call" in msg
+    )
+
+
+def is_session_error(exc: Exception) -> bool:
+    if isinstance(exc, (ConnectionError, asyncio.TimeoutError)):
+        return True
+    msg = f"{exc.__class__.__name__} {exc}".lower()
+    return any(
+        marker in msg
+        for marker in (
+            "auth_key",
+            "authkey",
+            "session_revoked",
+            "session revoked",
+            "user_deactivated",
+            "unauthorized",
+            "not connected",
+            "disconnected",
+            "connection lost",
+            "client has not been started",
+            "rpc_call_fail",
+            "internalservererror",
+        )
     )
 
 
+def classify_error(exc: Exception) -> str:
+    if is_peer_invalid_error(exc):
+        return "peer_invalid"
+    if is_groupcall_forbidden(exc):
+        return "groupcall_forbidden"
+    if is_voice_chat_missing(exc):
+        return "voice_chat_missing"
+    return "other"
+
+
 def explain_play_error(exc: Exception) -> str:
     if is_peer_invalid_error(exc):
         return (
@@ -205,32 +2574,81 @@ def explain_play_error(exc: Exception) -> str:
     return "Failed to start playback. Please ensure the voice chat is started and try again."
 
 
-def preload_user_dialogs(user: Client) -> None:
-    try:
-        for _ in user.get_dialogs():
-            pass
-        logger.info("User dialogs preloaded.")
-    except Exception as exc:
-        logger.warning("Failed to preload user dialogs: %s", exc)
-
-
 async def ensure_user_peer(user: Client, chat_id: int) -> None:
+    session = user.session_for(chat_id)
+    if peer_cache.verified(session, chat_id):
+        return
     try:
-        await user.get_chat(chat_id)
+        with tracer.span("ensure_user_peer", chat_id=chat_id), PEER_CHECK_SECONDS.time():
+            try:
+                await user.get_chat(chat_id)
+            except Exception as exc:
+                if not is_peer_invalid_error(exc) or not await peer_cache.wait_warm(session, PEER_WARMUP_WAIT_SECONDS):
+                    raise
+                await user.get_chat(chat_id)
     except Exception as exc:
         logger.warning("Userbot cannot access chat %s: %s", chat_id, exc)
+        PLAY_ERRORS.inc(kind=classify_error(exc))
+        peer_cache.invalidate(session, chat_id)
         raise
+    peer_cache.mark(session, chat_id)
+
+
+def remember_track(key: str, track: Track) -> None:
+    search_cache.put((key, normalize_query(track.webpage_url)), replace(track, requested_by=""))
+
 
+async def fetch_track(query: str, key: str, chat_id: int, priority: int) -> Track:
+    with tracer.span("extract", chat_id=chat_id, priority=priority):
+        track = await extraction_executor.submit(chat_id, priority, extract_track, query, "")
+    remember_track(key, track)
+    return track
 
-def search_track(query: str, requested_by: str) -> Track:
-    ydl_opts = {
-        "format": "bestaudio[ext=m4a]/bestaudio/best",
-        "default_search": "ytsearch1",
-        "quiet": True,
-        "noplaylist": True,
-        "extract_flat": False,
-    }
-    with YoutubeDL(ydl_opts) as ydl:
+
+def _forget_inflight(key: str, future: "asyncio.Future[Track]") -> None:
+    if inflight_searches.get(key) is future:
+        del inflight_searches[key]
+    if not future.cancelled():
+        future.exception()
+
+
+async def resolve_track(
+    query: str,
+    requested_by: str,
+    chat_id: int = 0,
+    priority: int = PRIORITY_DEEP,
+) -> Track:
+    global coalesced_searches
+    started = time.perf_counter()
+    key = normalize_query(query)
+    with tracer.span("resolve_track", chat_id=chat_id) as span:
+        local = library.search(query, requested_by)
+        if local:
+            span["source"] = "library"
+            SEARCH_SECONDS.observe(time.perf_counter() - started, source="library")
+            return local
+        cached = search_cache.get(key)
+        if cached:
+            span["source"] = "cache"
+            SEARCH_SECONDS.observe(time.perf_counter() - started, source="cache")
+            return replace(cached, requested_by=requested_by)
+
+        future = inflight_searches.get(key)
+        if future is None:
+            span["source"] = "extract"
+            future = asyncio.ensure_future(fetch_track(query, key, chat_id, priority))
+            inflight_searches[key] = future
+            future.add_done_callback(lambda fut: _forget_inflight(key, fut))
+        else:
+            span["source"] = "coalesced"
+            coalesced_searches += 1
+        track = await asyncio.shield(future)
+    SEARCH_SECONDS.observe(time.perf_counter() - started, source=span["source"])
+    return replace(track, requested_by=requested_by)
+
+
+def extract_track(query: str, requested_by: str) -> Track:
+    with youtube_dl_pool.checkout() as ydl:
         info = ydl.extract_info(query, download=False)
 
     entry = info["entries"][0] if "entries" in info else info
@@ -250,44 +2668,358 @@ def search_track(query: str, requested_by: str) -> Track:
     )
 
 
-async def start_or_enqueue(chat_id: int, track: Track, calls: PyTgCalls, bot: Client, user: Client) -> str:
-    position = await queue.push(chat_id, track)
-    if active_calls.get(chat_id):
-        return f"Добавлено в очередь #{position}: {track.title}"
+def track_needs_refresh(track: Track, horizon: float) -> bool:
+    if not track.direct_url:
+        return True
+    expiry = stream_url_expiry(track.direct_url)
+    return expiry is not None and expiry < time.time() + horizon
+
+
+async def refresh_track(chat_id: int, track: Track, horizon: float, priority: int = PRIORITY_NEXT) -> None:
+    query = track.webpage_url or track.title
+    cached = search_cache.get(normalize_query(query))
+    if cached and not track_needs_refresh(cached, horizon):
+        fresh = cached
+    else:
+        fresh = await extraction_executor.submit(chat_id, priority, extract_track, query, "")
+        remember_track(normalize_query(query), fresh)
+    track.direct_url = fresh.direct_url
+    if not track.webpage_url:
+        track.webpage_url = fresh.webpage_url
+    if not track.duration:
+        track.duration = fresh.duration
 
-    next_track = await queue.peek(chat_id)
-    if not next_track:
-        return "Очередь пуста."
 
+def stream_url_alive(url: str) -> bool:
+    request = Request(url, headers={"Range": "bytes=0-0", "User-Agent": "Mozilla/5.0"})
     try:
-        await play_track(calls, user, chat_id, next_track)
+        with urlopen(request, timeout=10) as response:
+            response.read(1)
+    except HTTPError as exc:
+        if exc.code in (403, 404, 410):
+            return False
+        logger.debug("Stream URL check returned HTTP %s", exc.code)
     except Exception as exc:
-        logger.exception("Failed to start call in chat %s", chat_id)
-        active_calls[chat_id] = True
-        current_track[chat_id] = next_track
-        ensure_reconnect(chat_id, calls, bot, user)
-        return (
-            f"{explain_play_error(exc)}\nError: {exc}"
+        logger.debug("Stream URL check failed: %s", exc)
+    return True
+
+
+async def prefetch_next(chat_id: int) -> None:
+    try:
+        nxt = await queue.get(chat_id, 1)
+        if not nxt:
+            return
+        now_playing = current_track.get(chat_id)
+        horizon = (now_playing.duration or 0) + STREAM_URL_MIN_TTL_SECONDS if now_playing else 0
+        if track_needs_refresh(nxt, horizon):
+            await refresh_track(chat_id, nxt, horizon)
+            state_store.mark_dirty(chat_id)
+        if PREFETCH_CHECK_URL and nxt.direct_url.startswith(("http://", "https://")):
+            if not await asyncio.to_thread(stream_url_alive, nxt.direct_url):
+                nxt.direct_url = ""
+                await refresh_track(chat_id, nxt, horizon)
+                state_store.mark_dirty(chat_id)
+        logger.debug("Prefetched next track for chat %s: %s", chat_id, nxt.title)
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:
+        logger.warning("Failed to prefetch next track in chat %s: %s", chat_id, exc)
+    finally:
+        prefetch_tasks.pop(chat_id, None)
+
+
+def schedule_prefetch(chat_id: int) -> None:
+    if not PREFETCH_ENABLED:
+        return
+    task = prefetch_tasks.get(chat_id)
+    if task and not task.done():
+        return
+    prefetch_tasks[chat_id] = asyncio.create_task(prefetch_next(chat_id))
+
+
+def is_playlist_url(query: str) -> bool:
+    if not query.lower().startswith(("http://", "https://")):
+        return False
+    parsed = urlparse(query)
+    path = parsed.path.lower()
+    if path == "/playlist" and "list" in parse_qs(parsed.query):
+        return True
+    return any(part in path for part in ("/playlist/", "/album/", "/sets/"))
+
+
+def flat_entry_track(entry: Dict[str, Any], requested_by: str) -> Optional[Track]:
+    webpage_url = entry.get("webpage_url") or entry.get("url") or ""
+    if not webpage_url.startswith(("http://", "https://")) and entry.get("id"):
+        webpage_url = f"https://www.youtube.com/watch?v={entry['id']}"
+    if not webpage_url:
+        return None
+    return Track(
+        title=entry.get("title") or "Unknown title",
+        webpage_url=webpage_url,
+        direct_url="",
+        duration=int(entry["duration"]) if entry.get("duration") else None,
+        requested_by=requested_by,
+    )
+
+
+def extract_playlist(url: str, requested_by: str, limit: int) -> Tuple[str, List[Track]]:
+    tracks: List[Track] = []
+    with playlist_dl_pool.checkout() as ydl:
+        info = ydl.extract_info(url, download=False)
+        for entry in info.get("entries") or []:
+            if len(tracks) >= limit:
+                break
+            track = flat_entry_track(entry, requested_by) if entry else None
+            if track:
+                tracks.append(track)
+    if not tracks:
+        raise ValueError("Playlist is empty or unavailable.")
+    return info.get("title") or "playlist", tracks
+
+
+def search_candidates(query: str, limit: int) -> List[Track]:
+    with playlist_dl_pool.checkout() as ydl:
+        info = ydl.extract_info(f"ytsearch{limit}:{query}", download=False)
+    tracks = [flat_entry_track(entry, "") for entry in info.get("entries") or [] if entry]
+    return [track for track in tracks if track][:limit]
+
+
+def remember_candidates(chat_id: int, tracks: List[Track], message_id: int) -> None:
+    now = time.monotonic()
+    for stale in [key for key, (expires_at, _, _) in search_results.items() if expires_at <= now]:
+        del search_results[stale]
+    search_results[chat_id] = (now + SEARCH_RESULTS_TTL_SECONDS, tracks, message_id)
+
+
+def search_list_id(chat_id: int) -> Optional[int]:
+    entry = search_results.get(chat_id)
+    return entry[2] if entry else None
+
+
+def inline_keyboard(rows: List[List[Tuple[str, str]]]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(text, callback_data=data) for text, data in row] for row in rows]
+    )
+
+
+def candidates_keyboard(count: int) -> InlineKeyboardMarkup:
+    buttons = [(str(i), f"pick:{i}") for i in range(1, count + 1)]
+    return inline_keyboard([buttons[i:i + 5] for i in range(0, len(buttons), 5)])
+
+
+async def pick_candidate(m: Message, calls: PyTgCalls, bot: Client, user: Client) -> None:
+    if not await ensure_group_context(m):
+        return
+    entry = search_results.get(m.chat.id)
+    if entry is None or entry[0] <= time.monotonic():
+        search_results.pop(m.chat.id, None)
+        await m.reply_text("Список результатов устарел, повторите /search.")
+        return
+    tracks = entry[1]
+    try:
+        index = int(m.command[1])
+    except (IndexError, ValueError):
+        await m.reply_text("Использование: /pick <номер из /search>")
+        return
+    if not 1 <= index <= len(tracks):
+        await m.reply_text(f"Нет варианта #{index}, выберите от 1 до {len(tracks)}.")
+        return
+    try:
+        await ensure_user_peer(user, m.chat.id)
+    except Exception:
+        await m.reply_text(
+            "Userbot cannot access this group. Add the user account to the group and open the chat at least once, "
+            "then retry /play."
         )
+        return
+    requested_by = m.from_user.mention if m.from_user else "unknown"
+    track = replace(tracks[index - 1], requested_by=requested_by)
+    try:
+        status = await start_or_enqueue(m.chat.id, track, calls, bot, user)
+    except NodeBusy as exc:
+        status = f"Сервер загружен ({exc}), новые звонки сейчас не принимаются. Попробуйте позже."
+    except Exception as exc:
+        status = f"Ошибка добавления: {exc}"
+    await m.reply_text(status)
+
+
+def pick_message(message: Message, from_user: Any, number: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=message.id,
+        chat=message.chat,
+        from_user=from_user,
+        command=["pick", number],
+        reply_text=message.reply_text,
+    )
+
+
+def register_pick_shortcuts(
+    bot: Client, dispatch: Callable[[Any], Awaitable[None]], list_id: Callable[[int], Optional[int]]
+) -> None:
+    @bot.on_callback_query(filters.regex(r"^pick:\d+$"))
+    async def pick_button(_, query: CallbackQuery):
+        if query.message.id != list_id(query.message.chat.id):
+            await query.answer("Список результатов устарел, повторите /search.")
+            return
+        await query.answer()
+        await dispatch(pick_message(query.message, query.from_user, query.data.split(":", 1)[1]))
+
+    @bot.on_message(filters.reply & filters.regex(r"^\s*\d{1,2}\s*$"))
+    async def pick_reply(_, m: Message):
+        replied = m.reply_to_message
+        if not replied or replied.id != list_id(m.chat.id):
+            return
+        await dispatch(pick_message(m, m.from_user, m.text.strip()))
+
+
+async def enqueue_playlist(
+    chat_id: int,
+    url: str,
+    requested_by: str,
+    priority: int,
+    calls: PyTgCalls,
+    bot: Client,
+    user: Client,
+) -> str:
+    busy = None if active_calls.get(chat_id) else admit(chat_id)
+    title, tracks = await extraction_executor.submit(
+        chat_id, priority, extract_playlist, url, requested_by, PLAYLIST_MAX_TRACKS
+    )
+    total = await queue.extend(chat_id, tracks)
+    summary = f"Из плейлиста «{title}» добавлено треков: {len(tracks)}"
+    if active_calls.get(chat_id):
+        if total - len(tracks) <= 2:
+            schedule_prefetch(chat_id)
+        return f"{summary}. В очереди: {total}"
+    if busy:
+        return f"{summary}.\n{waitlist_chat(chat_id, busy, calls, bot, user)}"
+    with admission.starting(chat_id):
+        return f"{summary}.\n{await start_playback(chat_id, calls, bot, user)}"
+
+
+def admit(chat_id: int) -> Optional[str]:
+    reason = admission.full_reason()
+    if reason and not admission.waitlist_enabled:
+        admission.rejected += 1
+        raise NodeBusy(reason)
+    return reason
+
+
+def waitlist_chat(chat_id: int, reason: str, calls: PyTgCalls, bot: Client, user: Client) -> str:
+    position = admission.waitlist(chat_id, calls, bot, user)
+    return (
+        f"Сервер загружен ({reason}). Чат в листе ожидания #{position}, "
+        "воспроизведение начнется автоматически, когда освободится место."
+    )
+
+
+async def start_or_enqueue(chat_id: int, track: Track, calls: PyTgCalls, bot: Client, user: Client) -> str:
+    with tracer.span("start_or_enqueue", chat_id=chat_id) as span:
+        busy = None if active_calls.get(chat_id) else admit(chat_id)
+        with tracer.span("queue_push", chat_id=chat_id):
+            position = await queue.push(chat_id, track)
+        span["position"] = position
+        if active_calls.get(chat_id):
+            if position == 2:
+                schedule_prefetch(chat_id)
+            return f"Добавлено в очередь #{position}: {track.title}"
+        if busy:
+            return f"Добавлено в очередь #{position}: {track.title}\n{waitlist_chat(chat_id, busy, calls, bot, user)}"
+        with admission.starting(chat_id):
+            return await start_playback(chat_id, calls, bot, user)
+
+
+async def start_playback(chat_id: int, calls: PyTgCalls, bot: Client, user: Client) -> str:
+    skipped: List[str] = []
+    reaper.reset_call(chat_id)
+    while True:
+        next_track = await queue.peek(chat_id)
+        if not next_track:
+            return "\n".join(skipped + ["Очередь пуста."])
+        try:
+            await play_track(calls, user, chat_id, next_track)
+            break
+        except TrackUnavailable as exc:
+            logger.warning("Skipping unavailable track in chat %s: %s", chat_id, exc)
+            skipped.append(skip_notice(next_track, exc))
+            await queue.pop(chat_id)
+        except Exception as exc:
+            logger.exception("Failed to start call in chat %s", chat_id)
+            active_calls[chat_id] = True
+            current_track[chat_id] = next_track
+            state_store.mark_dirty(chat_id)
+            ensure_reconnect(chat_id, calls, bot, user)
+            return "\n".join(skipped + [f"{explain_play_error(exc)}\nError: {exc}"])
 
     active_calls[chat_id] = True
     current_track[chat_id] = next_track
-    return (
-        f"Сейчас играет: {next_track.title} ({format_duration(next_track.duration)})\n"
-        f"Источник: {next_track.webpage_url or 'n/a'}"
+    state_store.mark_dirty(chat_id)
+    schedule_prefetch(chat_id)
+    return "\n".join(
+        skipped
+        + [
+            f"Сейчас играет: {next_track.title} ({format_duration(next_track.duration)})\n"
+            f"Источник: {next_track.webpage_url or 'n/a'}"
+        ]
     )
 
 
-async def play_track(calls: PyTgCalls, user: Client, chat_id: int, track: Track) -> None:
+def skip_notice(track: Track, exc: Exception) -> str:
+    return f"Не удалось получить «{track.title}», пропускаю: {exc}"
+
+
+async def play_track(calls: PyTgCalls, user: Client, chat_id: int, track: Track, offset: float = 0.0) -> None:
+    with tracer.span("play_track", chat_id=chat_id, offset=round(offset, 1)) as span:
+        await _play_track(calls, user, chat_id, track, offset, span)
+
+
+async def _play_track(
+    calls: PyTgCalls, user: Client, chat_id: int, track: Track, offset: float, span: Dict[str, Any]
+) -> None:
     await ensure_user_peer(user, chat_id)
-    stream = AudioPiped(track.direct_url) if AudioPiped else track.direct_url
-    await calls.play(chat_id, stream)
+    local = is_local_track(track)
+    source = track.direct_url if local else audio_cache.lookup(track.webpage_url)
+    span["audio_cache"] = bool(source) and not local
+    if not source:
+        if track_needs_refresh(track, STREAM_URL_MIN_TTL_SECONDS):
+            logger.info("Refreshing stream URL for chat %s: %s", chat_id, track.title)
+            with tracer.span("refresh_track", chat_id=chat_id):
+                try:
+                    await refresh_track(chat_id, track, STREAM_URL_MIN_TTL_SECONDS)
+                except ExecutorBusy:
+                    raise
+                except Exception as exc:
+                    raise TrackUnavailable(str(exc)) from exc
+        if offset >= 1:
+            # A fresh proxy download starts at byte 0, so a seek through it would fetch the played prefix first.
+            source = track.direct_url
+        else:
+            with tracer.span("stream_proxy", chat_id=chat_id):
+                source = await stream_proxy.url_for(track)
+    stream = build_stream(source, offset)
+    try:
+        with tracer.span("calls_play", chat_id=chat_id), CALLS_PLAY_SECONDS.time():
+            await calls.play(chat_id, stream)
+    except Exception as exc:
+        PLAY_ERRORS.inc(kind=classify_error(exc))
+        peer_cache.invalidate(user.session_for(chat_id), chat_id)
+        if session_pool is not None:
+            session_pool.report_failure(chat_id, exc)
+        raise
+    if session_pool is not None:
+        session_pool.report_success(chat_id)
+    if FFMPEG_NICE and Path("/proc").is_dir():
+        asyncio.get_running_loop().run_in_executor(None, renice_ffmpeg_children)
+    audio_cache.note_played(track, source)
+    playback_clock.start(chat_id, track, offset)
     if chat_id in paused_calls:
         try:
             await pause_stream(calls, chat_id)
+            playback_clock.pause(chat_id)
         except Exception as exc:
             logger.warning("Failed to re-apply pause for chat %s: %s", chat_id, exc)
             paused_calls.discard(chat_id)
+            state_store.mark_dirty(chat_id)
 
 
 async def _call_with_fallback(calls: PyTgCalls, chat_id: int, names: tuple[str, ...]) -> None:
@@ -323,8 +3055,15 @@ async def leave_call(calls: PyTgCalls, chat_id: int) -> None:
     )
 
 
+async def reconnect_priority(chat_id: int) -> Tuple[int, int]:
+    return (1 if chat_id in paused_calls else 0, -await queue.size(chat_id))
+
+
 async def reconnect_worker(chat_id: int, calls: PyTgCalls, bot: Client, user: Client) -> None:
     attempt = 0
+    failures = 0
+    tripped = False
+    started = time.perf_counter()
     try:
         while active_calls.get(chat_id):
             track = current_track.get(chat_id)
@@ -333,131 +3072,828 @@ async def reconnect_worker(chat_id: int, calls: PyTgCalls, bot: Client, user: Cl
 
             attempt += 1
             if RECONNECT_MAX_ATTEMPTS > 0 and attempt > RECONNECT_MAX_ATTEMPTS:
-                await bot.send_message(
+                reconnect_scheduler.gave_up += 1
+                RECONNECT_ATTEMPTS.inc(result="gave_up")
+                notify(
+                    bot,
                     chat_id,
                     "Реконнект не удался: превышено число попыток. Используйте /play снова.",
+                    "reconnect",
                 )
                 active_calls[chat_id] = False
+                state_store.mark_dirty(chat_id)
                 return
 
             try:
-                await play_track(calls, user, chat_id, track)
-                await bot.send_message(chat_id, "Реконнект выполнен, воспроизведение восстановлено.")
+                offset = playback_clock.resume_offset(chat_id, track)
+                async with reconnect_scheduler.slot(await reconnect_priority(chat_id)):
+                    await play_track(calls, user, chat_id, track, offset)
+                if offset:
+                    playback_clock.seeks += 1
+                    logger.info("Resumed chat %s at %.1f s of %s", chat_id, offset, track.title)
+                RECONNECT_SECONDS.observe(time.perf_counter() - started)
+                RECONNECT_ATTEMPTS.inc(result="ok")
+                reconnect_scheduler.recovered += 1
+                schedule_prefetch(chat_id)
+                notify(bot, chat_id, "Реконнект выполнен, воспроизведение восстановлено.", "reconnect")
+                return
+            except TrackUnavailable as exc:
+                logger.warning("Reconnect in chat %s skips unavailable track: %s", chat_id, exc)
+                notify(bot, chat_id, skip_notice(track, exc))
+                # Step aside first so a failure on the next track can schedule its own reconnect.
+                if reconnect_tasks.get(chat_id) is asyncio.current_task():
+                    del reconnect_tasks[chat_id]
+                await play_next(chat_id, calls, bot, user)
                 return
             except Exception as exc:
                 logger.warning("Reconnect attempt %s failed for chat %s: %s", attempt, chat_id, exc)
+                RECONNECT_ATTEMPTS.inc(result="failed")
                 if is_peer_invalid_error(exc):
                     active_calls[chat_id] = False
-                    try:
-                        await bot.send_message(chat_id, explain_play_error(exc))
-                    except Exception:
-                        logger.warning("Failed to send peer error message to %s", chat_id)
+                    state_store.mark_dirty(chat_id)
+                    notify(bot, chat_id, explain_play_error(exc), "reconnect")
                     return
                 if "valid stream object" in str(exc) or "stream classes found" in str(exc):
                     active_calls[chat_id] = False
+                    state_store.mark_dirty(chat_id)
                     return
-                await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                if isinstance(exc, FloodWait):
+                    reconnect_scheduler.pause(exc.value)
+                failures += 1
+                # Once tripped the breaker stays open: each cooldown allows a single probe, and a failed probe
+                # goes straight back into the cooldown. It closes only when an attempt succeeds.
+                if tripped or failures >= RECONNECT_BREAKER_THRESHOLD > 0:
+                    if not tripped:
+                        tripped = True
+                        reconnect_scheduler.breaker_trips += 1
+                        notify(
+                            bot,
+                            chat_id,
+                            f"Реконнект пока не удается, следующая попытка через "
+                            f"{RECONNECT_BREAKER_COOLDOWN_SECONDS} с. Можно использовать /reconnect.",
+                            "reconnect",
+                        )
+                    await asyncio.sleep(RECONNECT_BREAKER_COOLDOWN_SECONDS)
+                else:
+                    await asyncio.sleep(reconnect_backoff(failures))
     finally:
-        reconnect_tasks.pop(chat_id, None)
+        if reconnect_tasks.get(chat_id) is asyncio.current_task():
+            del reconnect_tasks[chat_id]
+
+
+def ensure_reconnect(chat_id: int, calls: PyTgCalls, bot: Client, user: Client, restart: bool = False) -> None:
+    task = reconnect_tasks.get(chat_id)
+    if task and not task.done():
+        if not restart:
+            return
+        task.cancel()
+    playback_clock.pause(chat_id)
+    reconnect_tasks[chat_id] = asyncio.create_task(reconnect_worker(chat_id, calls, bot, user))
+
+
+async def play_next(chat_id: int, calls: PyTgCalls, bot: Client, user: Client) -> None:
+    with tracer.span("play_next", chat_id=chat_id):
+        await _play_next(chat_id, calls, bot, user)
+
+
+async def _play_next(chat_id: int, calls: PyTgCalls, bot: Client, user: Client) -> None:
+    with tracer.span("queue_pop", chat_id=chat_id):
+        await queue.pop(chat_id)
+        nxt = await queue.peek(chat_id)
+    while nxt:
+        try:
+            await play_track(calls, user, chat_id, nxt)
+        except TrackUnavailable as exc:
+            # A lazily resolved track that cannot be fetched is skipped; it says nothing about the call itself.
+            logger.warning("Skipping unavailable track in chat %s: %s", chat_id, exc)
+            notify(bot, chat_id, skip_notice(nxt, exc))
+            await queue.pop(chat_id)
+            nxt = await queue.peek(chat_id)
+            continue
+        except Exception as exc:
+            track_ended_at.pop(chat_id, None)
+            logger.exception("Failed to play next track in chat %s", chat_id)
+            notify(bot, chat_id, f"{explain_play_error(exc)}\nError: {exc}")
+            ensure_reconnect(chat_id, calls, bot, user)
+            return
+        ended_at = track_ended_at.pop(chat_id, None)
+        if ended_at is not None:
+            TRACK_GAP_SECONDS.observe(time.perf_counter() - ended_at)
+        current_track[chat_id] = nxt
+        schedule_prefetch(chat_id)
+        notify(bot, chat_id, f"Следующий трек: {nxt.title} ({format_duration(nxt.duration)})", "track")
+        return
+
+    active_calls[chat_id] = False
+    current_track.pop(chat_id, None)
+    paused_calls.discard(chat_id)
+    playback_clock.stop(chat_id)
+    try:
+        await leave_call(calls, chat_id)
+    except Exception:
+        logger.warning("Failed to leave call in %s", chat_id)
+    if session_pool is not None:
+        session_pool.release(chat_id)
+    notify(bot, chat_id, "Очередь закончилась, вышел из звонка.", "track")
+    admission.kick()
+
+
+async def restore_state(
+    calls: PyTgCalls,
+    bot: Client,
+    user: Client,
+    chat_filter: Optional[Callable[[int], bool]] = None,
+) -> None:
+    saved = await state_store.load()
+    positions = await state_store.load_positions()
+    if chat_filter is not None:
+        saved = {chat_id: item for chat_id, item in saved.items() if chat_filter(chat_id)}
+    if not saved:
+        return
+    to_rejoin: List[int] = []
+    for chat_id, (active, paused, tracks) in saved.items():
+        if tracks:
+            await queue.extend(chat_id, tracks)
+        if paused:
+            paused_calls.add(chat_id)
+        if active and tracks:
+            active_calls[chat_id] = True
+            current_track[chat_id] = tracks[0]
+            to_rejoin.append(chat_id)
+    logger.info("Restored state for %s chats, rejoining %s calls.", len(saved), len(to_rejoin))
+    for chat_id in set(positions) - set(to_rejoin):
+        if chat_filter is None or chat_filter(chat_id):
+            playback_clock.stop(chat_id)
+
+    semaphore = asyncio.Semaphore(max(1, STATE_RESTORE_CONCURRENCY))
+
+    async def rejoin(chat_id: int) -> None:
+        async with semaphore:
+            track = current_track.get(chat_id)
+            if not active_calls.get(chat_id) or not track:
+                return
+            url, offset = positions.get(chat_id, ("", 0.0))
+            playback_clock.restore(chat_id, track, offset if url == track.webpage_url else 0.0)
+            try:
+                await play_track(calls, user, chat_id, track, playback_clock.resume_offset(chat_id, track))
+                schedule_prefetch(chat_id)
+            except TrackUnavailable as exc:
+                logger.warning("Skipping unavailable track in chat %s after restart: %s", chat_id, exc)
+                notify(bot, chat_id, skip_notice(track, exc))
+                await play_next(chat_id, calls, bot, user)
+            except Exception as exc:
+                logger.warning("Failed to rejoin call in chat %s after restart: %s", chat_id, exc)
+                ensure_reconnect(chat_id, calls, bot, user)
+
+    started = time.monotonic()
+    await asyncio.gather(*(rejoin(chat_id) for chat_id in to_rejoin))
+    logger.info("Rejoined %s calls in %.1fs.", len(to_rejoin), time.monotonic() - started)
+
+
+class PlaybackClock:
+    def __init__(self, rewind: float) -> None:
+        self._rewind = rewind
+        self._urls: Dict[int, str] = {}
+        self._offsets: Dict[int, float] = {}
+        self._running_since: Dict[int, float] = {}
+        self._ended: Set[int] = set()
+        self.seeks = 0
+
+    def start(self, chat_id: int, track: Track, offset: float) -> None:
+        self._urls[chat_id] = track.webpage_url
+        self._offsets[chat_id] = offset
+        self._running_since[chat_id] = time.monotonic()
+        self._ended.discard(chat_id)
+
+    def restore(self, chat_id: int, track: Track, offset: float) -> None:
+        self._urls[chat_id] = track.webpage_url
+        self._offsets[chat_id] = offset
+        self._running_since.pop(chat_id, None)
+
+    def pause(self, chat_id: int) -> None:
+        since = self._running_since.pop(chat_id, None)
+        if since is not None:
+            self._offsets[chat_id] = self._offsets.get(chat_id, 0.0) + time.monotonic() - since
+
+    def resume(self, chat_id: int) -> None:
+        if chat_id in self._offsets and chat_id not in self._running_since:
+            self._running_since[chat_id] = time.monotonic()
+
+    def position(self, chat_id: int) -> float:
+        since = self._running_since.get(chat_id)
+        return self._offsets.get(chat_id, 0.0) + (time.monotonic() - since if since is not None else 0.0)
+
+    def resume_offset(self, chat_id: int, track: Track) -> float:
+        if self._urls.get(chat_id) != track.webpage_url:
+            return 0.0
+        offset = self.position(chat_id) - self._rewind
+        if track.duration:
+            offset = min(offset, track.duration - 5)
+        return max(0.0, offset)
+
+    def stop(self, chat_id: int) -> None:
+        self.forget(chat_id)
+        self._ended.add(chat_id)
+
+    def forget(self, chat_id: int) -> None:
+        self._urls.pop(chat_id, None)
+        self._offsets.pop(chat_id, None)
+        self._running_since.pop(chat_id, None)
+
+    async def checkpoint(self) -> None:
+        now = time.time()
+        upserts = [
+            (chat_id, url, round(self.position(chat_id), 1), now)
+            for chat_id, url in self._urls.items()
+            if active_calls.get(chat_id)
+        ]
+        ended, self._ended = list(self._ended), set()
+        if upserts or ended:
+            await state_store.write_positions(upserts, ended)
+
+    async def run(self, interval: int) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.checkpoint()
+            except Exception as exc:
+                logger.warning("Failed to save playback positions: %s", exc)
+
+    def stats(self) -> Dict[str, int]:
+        return {"tracked": len(self._offsets), "seeks": self.seeks}
+
+
+playback_clock = PlaybackClock(POSITION_REWIND_SECONDS)
+
+
+def forget_chat(chat_id: int) -> None:
+    for tasks in (reconnect_tasks, prefetch_tasks):
+        task = tasks.pop(chat_id, None)
+        if task and not task.done():
+            task.cancel()
+    active_calls.pop(chat_id, None)
+    current_track.pop(chat_id, None)
+    track_ended_at.pop(chat_id, None)
+    paused_calls.discard(chat_id)
+    queue.forget(chat_id)
+    admin_cache.invalidate(chat_id)
+    admission.discard(chat_id)
+    search_results.pop(chat_id, None)
+    reaper.forget(chat_id)
+    playback_clock.forget(chat_id)
+    if session_pool is not None:
+        session_pool.release(chat_id)
+
+
+async def leave_chat(chat_id: int, calls: PyTgCalls) -> None:
+    await queue.clear(chat_id)
+    active_calls[chat_id] = False
+    current_track.pop(chat_id, None)
+    paused_calls.discard(chat_id)
+    playback_clock.stop(chat_id)
+    for tasks in (reconnect_tasks, prefetch_tasks):
+        task = tasks.get(chat_id)
+        if task and not task.done():
+            task.cancel()
+    try:
+        await leave_call(calls, chat_id)
+    except Exception:
+        logger.warning("Failed to leave call in %s", chat_id)
+    if session_pool is not None:
+        session_pool.release(chat_id)
+    admission.discard(chat_id)
+    admission.kick()
+    reaper.reset_call(chat_id)
+
+
+class IdleReaper:
+    def __init__(self, idle_seconds: int, empty_call_seconds: int, probe_batch: int, probe_concurrency: int) -> None:
+        self._idle_seconds = idle_seconds
+        self._empty_call_seconds = empty_call_seconds
+        self._probe_batch = max(1, probe_batch)
+        self._probe_concurrency = max(1, probe_concurrency)
+        self._last_seen: Dict[int, float] = {}
+        self._unused_since: Dict[int, float] = {}
+        self._listener_counts: Dict[int, int] = {}
+        self._probed_at: Dict[int, float] = {}
+        self._probes_paused_until = 0.0
+        self.sweeps = 0
+        self.probes = 0
+        self.left = 0
+        self.forgotten = 0
+
+    def touch(self, chat_id: int) -> None:
+        self._last_seen[chat_id] = time.monotonic()
+
+    def forget(self, chat_id: int) -> None:
+        self._last_seen.pop(chat_id, None)
+        self.reset_call(chat_id)
+
+    def reset_call(self, chat_id: int) -> None:
+        self._unused_since.pop(chat_id, None)
+        self._listener_counts.pop(chat_id, None)
+        self._probed_at.pop(chat_id, None)
+
+    def tracked_chats(self) -> Set[int]:
+        return (
+            set(active_calls)
+            | set(current_track)
+            | set(queue.chat_ids())
+            | set(reconnect_tasks)
+            | set(prefetch_tasks)
+            | set(track_ended_at)
+            | set(search_results)
+            | paused_calls
+            | set(self._last_seen)
+        )
+
+    async def _probe(self, chat_id: int, get_participants: Callable, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            if time.monotonic() < self._probes_paused_until:
+                return
+            self._probed_at[chat_id] = time.monotonic()
+            self.probes += 1
+            try:
+                participants = await get_participants(chat_id)
+            except FloodWait as exc:
+                self._probes_paused_until = time.monotonic() + exc.value
+                logger.warning("Listener probes hit FloodWait, pausing them for %s s.", exc.value)
+                return
+            except Exception as exc:
+                logger.debug("Failed to list participants in %s: %s", chat_id, exc)
+                self._listener_counts.pop(chat_id, None)
+                return
+        self._listener_counts[chat_id] = max(0, len(participants) - 1)
+
+    async def _probe_listeners(self, calls: PyTgCalls) -> None:
+        # Each probe is a full participant list request on the userbot, so only the calls probed longest ago
+        # (those already seen empty first) are checked per sweep.
+        get_participants = getattr(calls, "get_participants", None)
+        if get_participants is None or time.monotonic() < self._probes_paused_until:
+            return
+        playing = [chat_id for chat_id, active in active_calls.items() if active]
+        playing.sort(key=lambda chat_id: (chat_id not in self._unused_since, self._probed_at.get(chat_id, 0.0)))
+        semaphore = asyncio.Semaphore(self._probe_concurrency)
+        await asyncio.gather(
+            *(self._probe(chat_id, get_participants, semaphore) for chat_id in playing[: self._probe_batch])
+        )
+
+    async def _leave_reason(self, chat_id: int, now: float) -> Optional[str]:
+        if current_track.get(chat_id) or await queue.size(chat_id):
+            if self._listener_counts.get(chat_id) != 0:
+                self._unused_since.pop(chat_id, None)
+                return None
+            reason = "no_listeners"
+            # Leave only once a probe taken after the grace period still shows the call empty.
+            checked = self._probed_at.get(chat_id, now)
+        else:
+            reason = "no_queue"
+            checked = now
+        since = self._unused_since.setdefault(chat_id, checked)
+        return reason if checked - since >= self._empty_call_seconds else None
+
+    async def sweep(self, calls: PyTgCalls, bot: Client) -> Tuple[int, int]:
+        if self._empty_call_seconds > 0:
+            await self._probe_listeners(calls)
+        now = time.monotonic()
+        left = forgotten = 0
+        for chat_id in self.tracked_chats():
+            task = reconnect_tasks.get(chat_id)
+            if (task and not task.done()) or admission.busy(chat_id):
+                self._last_seen[chat_id] = now
+                continue
+            if active_calls.get(chat_id):
+                self._last_seen[chat_id] = now
+                reason = await self._leave_reason(chat_id, now) if self._empty_call_seconds > 0 else None
+                if reason is None:
+                    continue
+                await leave_chat(chat_id, calls)
+                text = (
+                    "В звонке никого нет, вышел и очистил очередь."
+                    if reason == "no_listeners"
+                    else "Нечего играть, вышел из звонка."
+                )
+                notify(bot, chat_id, text, "track")
+                REAPER_ACTIONS.inc(action=f"left_{reason}")
+                state_store.mark_dirty(chat_id)
+                left += 1
+                continue
+            self.reset_call(chat_id)
+            if self._idle_seconds <= 0 or now - self._last_seen.setdefault(chat_id, now) < self._idle_seconds:
+                continue
+            forget_chat(chat_id)
+            state_store.mark_dirty(chat_id)
+            REAPER_ACTIONS.inc(action="forgot")
+            forgotten += 1
+        self.sweeps += 1
+        self.left += left
+        self.forgotten += forgotten
+        return left, forgotten
+
+    async def run(self, interval: int, calls: PyTgCalls, bot: Client) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                left, forgotten = await self.sweep(calls, bot)
+            except Exception as exc:
+                logger.warning("Reaper sweep failed: %s", exc)
+                continue
+            if left or forgotten:
+                logger.info(
+                    "Reaper left %s calls and dropped %s idle chats; %s chats tracked, %s stream slots in use.",
+                    left,
+                    forgotten,
+                    len(self.tracked_chats()),
+                    admission.in_use(),
+                )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "tracked": len(self.tracked_chats()),
+            "sweeps": self.sweeps,
+            "probes": self.probes,
+            "left": self.left,
+            "forgotten": self.forgotten,
+        }
 
 
-def ensure_reconnect(chat_id: int, calls: PyTgCalls, bot: Client, user: Client) -> None:
-    task = reconnect_tasks.get(chat_id)
-    if task and not task.done():
-        return
-    reconnect_tasks[chat_id] = asyncio.create_task(reconnect_worker(chat_id, calls, bot, user))
+reaper = IdleReaper(REAPER_IDLE_SECONDS, REAPER_EMPTY_CALL_SECONDS, REAPER_PROBE_BATCH, REAPER_PROBE_CONCURRENCY)
 
 
-async def play_next(chat_id: int, calls: PyTgCalls, bot: Client, user: Client) -> None:
-    await queue.pop(chat_id)
-    nxt = await queue.peek(chat_id)
-    if not nxt:
-        active_calls[chat_id] = False
-        current_track.pop(chat_id, None)
-        paused_calls.discard(chat_id)
-        try:
-            await leave_call(calls, chat_id)
-        except Exception:
-            logger.warning("Failed to leave call in %s", chat_id)
-        try:
-            await bot.send_message(chat_id, "Очередь закончилась, вышел из звонка.")
-        except Exception:
-            logger.warning("Failed to send end message to %s", chat_id)
-        return
+ADMIN_STATUSES = {ChatMemberStatus.OWNER, ChatMemberStatus.ADMINISTRATOR}
 
-    try:
-        await play_track(calls, user, chat_id, nxt)
-        current_track[chat_id] = nxt
-        await bot.send_message(
-            chat_id,
-            f"Следующий трек: {nxt.title} ({format_duration(nxt.duration)})",
-        )
-    except Exception as exc:
-        logger.exception("Failed to play next track in chat %s", chat_id)
-        await bot.send_message(
-            chat_id,
-            f"{explain_play_error(exc)}\nError: {exc}",
-        )
-        ensure_reconnect(chat_id, calls, bot, user)
+
+class AdminCache:
+    def __init__(self, ttl: int) -> None:
+        self._ttl = ttl
+        self._entries: Dict[int, Tuple[float, Set[int]]] = {}
+        self._inflight: Dict[int, "asyncio.Future[Set[int]]"] = {}
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    async def admins(self, bot: Client, chat_id: int) -> Set[int]:
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        future = self._inflight.get(chat_id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = future
+            future.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, bot: Client, chat_id: int) -> Set[int]:
+        admins: Set[int] = set()
+        async for member in bot.get_chat_members(chat_id, filter=ChatMembersFilter.ADMINISTRATORS):
+            if member.user is not None:
+                admins.add(member.user.id)
+        self._entries[chat_id] = (time.monotonic() + self._ttl, admins)
+        return admins
+
+    def apply_update(self, chat_id: int, user_id: int, status: Any) -> None:
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return
+        self.updates += 1
+        if status in ADMIN_STATUSES:
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
+
+    def invalidate(self, chat_id: int) -> None:
+        self._entries.pop(chat_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"chats": len(self._entries), "hits": self.hits, "misses": self.misses, "updates": self.updates}
+
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL_SECONDS)
 
 
 async def is_privileged_user(bot: Client, m: Message) -> bool:
+    privileged = getattr(m, "privileged", None)
+    if privileged is not None:
+        return privileged
     if not m.from_user:
         return False
     user_id = m.from_user.id
     if user_id in PRIVILEGED_USER_IDS:
         return True
+    try:
+        return user_id in await admin_cache.admins(bot, m.chat.id)
+    except Exception as exc:
+        logger.debug("Admin list lookup failed for chat %s: %s", m.chat.id, exc)
     try:
         member = await bot.get_chat_member(m.chat.id, user_id)
     except Exception:
         return False
-    return member.status in {
-        ChatMemberStatus.OWNER,
-        ChatMemberStatus.ADMINISTRATOR,
-    }
+    return member.status in ADMIN_STATUSES
+
+
+def build_loop_report() -> str:
+    health = loop_monitor.stats()
+    executor = extraction_executor.stats()
+    lines = [
+        "Event loop:",
+        (
+            f"Задержка таймеров: p50 {health['lag_p50'] * 1000:.1f} мс, p99 {health['lag_p99'] * 1000:.1f} мс, "
+            f"макс. {health['lag_max'] * 1000:.1f} мс"
+        ),
+        f"Блокировок дольше {LOOP_STALL_THRESHOLD_MS} мс: {health['stalls']}",
+        (
+            f"Извлечение: занято {executor['running']}/{EXTRACT_WORKERS} потоков, в очереди {executor['depth']}, "
+            f"все заняты {health['extract_saturation'] * 100:.0f}% времени"
+        ),
+        (
+            f"Пул потоков loop: старт задачи ср. {health['executor_wait_avg'] * 1000:.1f} мс / "
+            f"макс. {health['executor_wait_max'] * 1000:.1f} мс"
+        ),
+    ]
+    if loop_monitor.stalls:
+        at, duration, stack = loop_monitor.stalls[-1]
+        lines.append(f"Последняя блокировка: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(at))}, {duration:.2f} с")
+        lines.append(stack[-2500:] or "стек недоступен")
+    return "\n".join(lines)
+
+
+def build_stats_lines() -> List[str]:
+    cache = search_cache.stats()
+    queues = queue.stats()
+    state = state_store.stats()
+    executor = extraction_executor.stats()
+    ydl_pool = youtube_dl_pool.stats()
+    audio = audio_cache.stats()
+    proxy = stream_proxy.stats()
+    reconnects = reconnect_scheduler.stats()
+    sends = outbox.stats()
+    slots = admission.stats()
+    local = library.stats()
+    admins = admin_cache.stats()
+    peers = peer_cache.stats()
+    reaped = reaper.stats()
+    lookups = cache["hits"] + cache["misses"]
+    hit_rate = cache["hits"] * 100 / lookups if lookups else 0.0
+    return [
+        "Статистика:",
+        f"Активных звонков: {sum(1 for v in active_calls.values() if v)}",
+        (
+            f"Слоты потоков: занято {slots['in_use']}/{slots['limit'] or '∞'}, в листе ожидания {slots['waitlist']}, "
+            f"отклонено {slots['rejected']}, запущено из листа {slots['promoted']}"
+        ),
+        *(
+            f"Сессия {name}: {'ok' if healthy else 'сбой'}, звонков {load}, ошибок подряд {failures}"
+            for name, healthy, load, failures in (session_pool.stats() if session_pool else [])
+        ),
+        (
+            f"Реконнекты: ждут {reconnects['waiting']}, выполняются {reconnects['running']}, "
+            f"попыток {reconnects['attempts']}, восстановлено {reconnects['recovered']}, "
+            f"сдались {reconnects['gave_up']}, пауз по ошибкам {reconnects['breaker_trips']}, "
+            f"продолжено с позиции {playback_clock.stats()['seeks']}"
+        ),
+        (
+            f"Уведомления: в очереди {sends['pending']}, отправлено {sends['sent']}, "
+            f"объединено {sends['coalesced']}, отброшено {sends['dropped']}, FloodWait {sends['flood_waits']}, "
+            f"ошибок {sends['failed']}"
+        ),
+        f"Очереди: {queues['chats']} чатов, {queues['tracks']} треков, блокировок {queues['locks']}",
+        (
+            f"Очистка: отслеживается {reaped['tracked']} чатов, вышел из {reaped['left']} пустых звонков, "
+            f"забыто {reaped['forgotten']} чатов"
+        ),
+        f"Сохранение состояния: ожидает {state['dirty']} чатов, записей {state['flushes']}, строк {state['rows_written']}",
+        (
+            f"Кэш поиска: {cache['size']}/{SEARCH_CACHE_SIZE}, попаданий {cache['hits']}, "
+            f"промахов {cache['misses']} ({hit_rate:.1f}%), вытеснено {cache['evictions']}, "
+            f"истекло {cache['expirations']}"
+        ),
+        *(
+            [
+                f"Локальная библиотека: {local['files']} файлов, попаданий {local['hits']}, "
+                f"промахов {local['misses']}, сканирований {local['scans']}"
+            ]
+            if library.enabled
+            else []
+        ),
+        f"Поисков в процессе: {len(inflight_searches)}, объединено запросов: {coalesced_searches}",
+        (
+            f"Извлечение: в очереди {executor['depth']} (следующие {executor['depth_next']}, "
+            f"глубокие {executor['depth_deep']}), выполняется {executor['running']}, "
+            f"готово {executor['completed']}, отклонено {executor['rejected']}, "
+            f"ожидание ср. {executor['wait_avg']:.2f}с / макс. {executor['wait_max']:.2f}с"
+        ),
+        (
+            f"Аудиокэш: {audio['files']} файлов, {audio['bytes'] / 1048576:.1f}/{AUDIO_CACHE_MAX_MB} МБ, "
+            f"попаданий {audio['hits']}, промахов {audio['misses']}, сохранено {audio['stored']}, "
+            f"вытеснено {audio['evictions']}, ошибок {audio['failures']}"
+        ),
+        (
+            f"Прокси потоков: {proxy['streams']} потоков, {proxy['readers']} читателей, "
+            f"запросов к источнику {proxy['upstream_requests']}, раздач {proxy['served']}, "
+            f"отдано {proxy['bytes_served'] / 1048576:.1f} МБ"
+        ),
+        (
+            f"Кэш peer: {peers['size']} чатов, попаданий {peers['hits']}, промахов {peers['misses']}, "
+            f"прогрето диалогов {peers['warmed']}, прогревается сессий {peers['warming']}"
+        ),
+        (
+            f"Кэш администраторов: {admins['chats']} чатов, попаданий {admins['hits']}, "
+            f"промахов {admins['misses']}, обновлений {admins['updates']}"
+        ),
+        (
+            f"YoutubeDL: живых {ydl_pool['alive']}, свободных {ydl_pool['idle']}, "
+            f"создано {ydl_pool['created']}, пересоздано {ydl_pool['recycled']}"
+        ),
+    ]
 
 
 async def ensure_group_context(m: Message) -> bool:
     if m.chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
+        reaper.touch(m.chat.id)
         return True
     await m.reply_text("Эта команда работает только в группе с активным голосовым чатом.")
     return False
 
 
-def build_clients() -> tuple[Client, Client, PyTgCalls]:
-    bot_client = Client(
+def stable_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class Shard:
+    def __init__(self, name: str, user: Client, calls: PyTgCalls) -> None:
+        self.name = name
+        self.user = user
+        self.calls = calls
+        self.healthy = True
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class SessionPool:
+    VIRTUAL_NODES = 64
+
+    def __init__(self, shards: List[Shard], max_calls: int, failure_threshold: int, retry_seconds: int) -> None:
+        self.shards = shards
+        self._by_name = {shard.name: shard for shard in shards}
+        self._max_calls = max_calls
+        self._failure_threshold = max(1, failure_threshold)
+        self._retry_seconds = retry_seconds
+        self._assignments: Dict[int, str] = {}
+        self.on_failover: Optional[Callable[[Shard, List[int], int], None]] = None
+        self.failovers = 0
+        ring = []
+        for shard in shards:
+            for replica in range(self.VIRTUAL_NODES):
+                ring.append((stable_hash(f"{shard.name}#{replica}"), shard.name))
+        ring.sort()
+        self._ring = ring
+
+    def _available(self, shard: Shard) -> bool:
+        return shard.healthy or time.monotonic() >= shard.retry_at
+
+    def load(self, shard: Shard) -> int:
+        return sum(
+            1 for chat_id, name in self._assignments.items() if name == shard.name and active_calls.get(chat_id)
+        )
+
+    def _candidates(self, chat_id: int) -> List[Shard]:
+        if len(self.shards) == 1:
+            return list(self.shards)
+        start = stable_hash(str(chat_id))
+        index = next((i for i, (point, _) in enumerate(self._ring) if point >= start), 0)
+        ordered: List[Shard] = []
+        for offset in range(len(self._ring)):
+            name = self._ring[(index + offset) % len(self._ring)][1]
+            shard = self._by_name[name]
+            if shard not in ordered:
+                ordered.append(shard)
+                if len(ordered) == len(self.shards):
+                    break
+        return ordered
+
+    def shard_for(self, chat_id: int) -> Shard:
+        name = self._assignments.get(chat_id)
+        if name is not None and self._available(self._by_name[name]):
+            return self._by_name[name]
+
+        candidates = self._candidates(chat_id)
+        available = [shard for shard in candidates if self._available(shard)] or candidates
+        chosen = next(
+            (shard for shard in available if self._max_calls <= 0 or self.load(shard) < self._max_calls),
+            None,
+        )
+        if chosen is None:
+            chosen = min(available, key=self.load)
+        self._assignments[chat_id] = chosen.name
+        return chosen
+
+    def release(self, chat_id: int) -> None:
+        self._assignments.pop(chat_id, None)
+
+    def report_success(self, chat_id: int) -> None:
+        shard = self.shard_for(chat_id)
+        shard.failures = 0
+        if not shard.healthy:
+            shard.healthy = True
+            logger.info("User session %s is healthy again.", shard.name)
+
+    def report_failure(self, chat_id: int, exc: Exception) -> None:
+        # Chat- and track-level errors (no voice chat, expired URL, ffmpeg) say nothing about the session.
+        if not is_session_error(exc):
+            return
+        shard = self.shard_for(chat_id)
+        shard.failures += 1
+        if len(self.shards) == 1 or shard.failures < self._failure_threshold:
+            return
+        shard.healthy = False
+        shard.retry_at = time.monotonic() + self._retry_seconds
+        moved = [cid for cid, name in self._assignments.items() if name == shard.name]
+        for cid in moved:
+            del self._assignments[cid]
+        self.failovers += 1
+        logger.warning("User session %s marked unhealthy, moving %s chats.", shard.name, len(moved))
+        if self.on_failover is not None:
+            self.on_failover(shard, [cid for cid in moved if active_calls.get(cid)], chat_id)
+
+    def stats(self) -> List[Tuple[str, bool, int, int]]:
+        return [(shard.name, shard.healthy, self.load(shard), shard.failures) for shard in self.shards]
+
+
+class ShardedCalls:
+    def __init__(self, pool: SessionPool) -> None:
+        self._pool = pool
+
+    def on_update(self, *args: Any, **kwargs: Any) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            for shard in self._pool.shards:
+                shard.calls.on_update(*args, **kwargs)(func)
+            return func
+
+        return decorator
+
+    def start(self) -> None:
+        for shard in self._pool.shards:
+            shard.calls.start()
+
+    def __getattr__(self, name: str) -> Callable:
+        if not hasattr(self._pool.shards[0].calls, name):
+            raise AttributeError(name)
+
+        async def routed(chat_id: int, *args: Any, **kwargs: Any) -> Any:
+            return await getattr(self._pool.shard_for(chat_id).calls, name)(chat_id, *args, **kwargs)
+
+        return routed
+
+
+class ShardedUser:
+    def __init__(self, pool: SessionPool) -> None:
+        self._pool = pool
+
+    def start(self) -> None:
+        for shard in self._pool.shards:
+            shard.user.start()
+
+    async def get_chat(self, chat_id: int) -> Any:
+        return await self._pool.shard_for(chat_id).user.get_chat(chat_id)
+
+    def session_for(self, chat_id: int) -> str:
+        return self._pool.shard_for(chat_id).name
+
+
+def build_bot_client() -> Client:
+    return Client(
         name="music_bot",
         api_id=API_ID,
         api_hash=API_HASH,
         bot_token=BOT_TOKEN,
     )
 
-    user_session_path = str(Path(SESSION_DIR) / SESSION_NAME)
-    user_client = Client(
-        name=user_session_path,
-        api_id=API_ID,
-        api_hash=API_HASH,
-        no_updates=True,
-    )
-    call_client = PyTgCalls(user_client)
-    return bot_client, user_client, call_client
 
+def build_user_clients() -> tuple[ShardedUser, ShardedCalls]:
+    global session_pool
+    shards = []
+    for name in SESSION_NAMES:
+        user_session_path = str(Path(SESSION_DIR) / name)
+        user_client = Client(
+            name=user_session_path,
+            api_id=API_ID,
+            api_hash=API_HASH,
+            no_updates=True,
+        )
+        shards.append(Shard(name, user_client, PyTgCalls(user_client)))
+    session_pool = SessionPool(shards, SESSION_MAX_CALLS, SESSION_FAILURE_THRESHOLD, SESSION_RETRY_SECONDS)
+    logger.info("User sessions: %s", ", ".join(SESSION_NAMES))
+    return ShardedUser(session_pool), ShardedCalls(session_pool)
 
-def main() -> None:
-    bot, user, calls = build_clients()
-    logger.info(
-        "Stream backend: url_play=True StreamAudioEnded=%s",
-        bool(StreamAudioEnded),
-    )
 
-    @calls.on_update()
-    async def stream_end_handler(_, update):
-        if StreamAudioEnded is not None and isinstance(update, StreamAudioEnded):
-            await play_next(update.chat_id, calls, bot, user)
-            return
-        if update.__class__.__name__ == "StreamAudioEnded" and hasattr(update, "chat_id"):
-            await play_next(update.chat_id, calls, bot, user)
+def build_clients() -> tuple[Client, ShardedUser, ShardedCalls]:
+    user, calls = build_user_clients()
+    return build_bot_client(), user, calls
 
+
+def register_basic_handlers(bot: Client) -> None:
     @bot.on_message(filters.command("start"))
     async def start_cmd(_, m: Message):
         await m.reply_text(HELP_TEXT)
@@ -470,13 +3906,52 @@ def main() -> None:
     async def ping_cmd(_, m: Message):
         await m.reply_text("pong")
 
+    @bot.on_chat_member_updated()
+    async def member_updated(_, update):
+        member = update.new_chat_member
+        if member is not None and member.user is not None:
+            admin_cache.apply_update(update.chat.id, member.user.id, member.status)
+        elif update.old_chat_member is not None and update.old_chat_member.user is not None:
+            admin_cache.apply_update(update.chat.id, update.old_chat_member.user.id, None)
+
+
+def register_handlers(bot: Client, calls: PyTgCalls, user: Client) -> None:
+    async def leave_old_shard(shard: Shard, chat_id: int) -> None:
+        try:
+            await leave_call(shard.calls, chat_id)
+        except Exception as exc:
+            logger.debug("Failed to leave call in %s on session %s: %s", chat_id, shard.name, exc)
+
+    def failover(shard: Shard, chat_ids: List[int], failed_chat_id: int) -> None:
+        for chat_id in chat_ids:
+            asyncio.create_task(leave_old_shard(shard, chat_id))
+            if chat_id != failed_chat_id:
+                ensure_reconnect(chat_id, calls, bot, user)
+
+    if session_pool is not None:
+        session_pool.on_failover = failover
+
+    @calls.on_update()
+    async def stream_end_handler(_, update):
+        if StreamAudioEnded is not None and isinstance(update, StreamAudioEnded):
+            track_ended_at[update.chat_id] = time.perf_counter()
+            await play_next(update.chat_id, calls, bot, user)
+            return
+        if update.__class__.__name__ == "StreamAudioEnded" and hasattr(update, "chat_id"):
+            track_ended_at[update.chat_id] = time.perf_counter()
+            await play_next(update.chat_id, calls, bot, user)
+
     @bot.on_message(filters.command("play"))
     async def play_cmd(_, m: Message):
         if not await ensure_group_context(m):
             return
         if len(m.command) < 2:
-            await m.reply_text("Использование: /play <название трека>")
+            await m.reply_text("Использование: /play <название трека или ссылка на плейлист>")
             return
+        with tracer.span("play_cmd", chat_id=m.chat.id):
+            await _play(m)
+
+    async def _play(m: Message) -> None:
         try:
             await ensure_user_peer(user, m.chat.id)
         except Exception as exc:
@@ -487,15 +3962,58 @@ def main() -> None:
             )
             return
         query = " ".join(m.command[1:]).strip()
-        await m.reply_text(f"Ищу: {query}")
+        with tracer.span("reply", chat_id=m.chat.id):
+            await m.reply_text(f"Ищу: {query}")
         try:
             requested_by = m.from_user.mention if m.from_user else "unknown"
-            track = await asyncio.to_thread(search_track, query, requested_by)
-            status = await start_or_enqueue(m.chat.id, track, calls, bot, user)
-            await m.reply_text(status)
+            priority = PRIORITY_DEEP if await queue.size(m.chat.id) > 1 else PRIORITY_NEXT
+            if is_playlist_url(query):
+                with tracer.span("enqueue_playlist", chat_id=m.chat.id):
+                    status = await enqueue_playlist(m.chat.id, query, requested_by, priority, calls, bot, user)
+            else:
+                track = await resolve_track(query, requested_by, m.chat.id, priority)
+                status = await start_or_enqueue(m.chat.id, track, calls, bot, user)
+            with tracer.span("reply", chat_id=m.chat.id):
+                await m.reply_text(status)
+        except ExecutorBusy:
+            await m.reply_text("Сейчас слишком много запросов, попробуйте через минуту.")
+        except NodeBusy as exc:
+            await m.reply_text(f"Сервер загружен ({exc}), новые звонки сейчас не принимаются. Попробуйте позже.")
         except Exception as exc:
             await m.reply_text(f"Ошибка поиска/добавления: {exc}")
 
+    @bot.on_message(filters.command("search"))
+    async def search_cmd(_, m: Message):
+        if not await ensure_group_context(m):
+            return
+        if len(m.command) < 2:
+            await m.reply_text("Использование: /search <запрос>")
+            return
+        query = " ".join(m.command[1:]).strip()
+        try:
+            tracks = await extraction_executor.submit(
+                m.chat.id, PRIORITY_NEXT, search_candidates, query, max(1, min(SEARCH_RESULTS, 10))
+            )
+        except ExecutorBusy:
+            await m.reply_text("Сейчас слишком много запросов, попробуйте через минуту.")
+            return
+        except Exception as exc:
+            await m.reply_text(f"Ошибка поиска: {exc}")
+            return
+        if not tracks:
+            await m.reply_text("Ничего не найдено.")
+            return
+        lines = [f"Результаты по запросу «{query}»:"]
+        lines.extend(f"{i}. {t.title} ({format_duration(t.duration)})" for i, t in enumerate(tracks, 1))
+        lines.append("Выберите кнопкой, ответом на это сообщение с номером или /pick <номер>.")
+        sent = await m.reply_text("\n".join(lines), reply_markup=candidates_keyboard(len(tracks)))
+        # Workers cannot see the relayed message id; the front tracks it for the reply shortcuts instead.
+        remember_candidates(m.chat.id, tracks, getattr(sent, "id", 0))
+
+    @bot.on_message(filters.command("pick"))
+    async def pick_cmd(_, m: Message):
+        await pick_candidate(m, calls, bot, user)
+
     @bot.on_message(filters.command("skip"))
     async def skip_cmd(_, m: Message):
         if not await ensure_group_context(m):
@@ -522,6 +4040,8 @@ def main() -> None:
         try:
             await pause_stream(calls, m.chat.id)
             paused_calls.add(m.chat.id)
+            playback_clock.pause(m.chat.id)
+            state_store.mark_dirty(m.chat.id)
             await m.reply_text("Пауза.")
         except Exception as exc:
             await m.reply_text(f"Не удалось поставить на паузу: {exc}")
@@ -539,6 +4059,8 @@ def main() -> None:
         try:
             await resume_stream(calls, m.chat.id)
             paused_calls.discard(m.chat.id)
+            playback_clock.resume(m.chat.id)
+            state_store.mark_dirty(m.chat.id)
             await m.reply_text("Продолжено.")
         except Exception as exc:
             await m.reply_text(f"Не удалось возобновить: {exc}")
@@ -553,24 +4075,69 @@ def main() -> None:
         if not active_calls.get(m.chat.id) or not current_track.get(m.chat.id):
             await m.reply_text("Нет активного трека для реконнекта.")
             return
-        ensure_reconnect(m.chat.id, calls, bot, user)
+        ensure_reconnect(m.chat.id, calls, bot, user, restart=True)
         await m.reply_text("Запущен реконнект.")
 
     @bot.on_message(filters.command("queue"))
     async def queue_cmd(_, m: Message):
         if not await ensure_group_context(m):
             return
-        items = await queue.list(m.chat.id)
-        if not items:
+        page = 1
+        if len(m.command) > 1 and m.command[1].isdigit():
+            page = max(1, int(m.command[1]))
+        offset = (page - 1) * QUEUE_PAGE_SIZE
+        items, total = await queue.page(m.chat.id, offset, QUEUE_PAGE_SIZE)
+        if not total:
             await m.reply_text("Очередь пуста.")
             return
-        lines = ["Очередь:"]
-        for i, tr in enumerate(items[:20], start=1):
+        if not items:
+            await m.reply_text(f"Такой страницы нет, всего треков: {total}.")
+            return
+        pages = (total + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE
+        lines = [f"Очередь ({total}), страница {page}/{pages}:"]
+        for i, tr in enumerate(items, start=offset + 1):
             lines.append(f"{i}. {tr.title} [{format_duration(tr.duration)}]")
-        if len(items) > 20:
-            lines.append(f"... и еще {len(items) - 20}")
+        if page < pages:
+            lines.append(f"Дальше: /queue {page + 1}")
         await m.reply_text("\n".join(lines))
 
+    @bot.on_message(filters.command("remove"))
+    async def remove_cmd(_, m: Message):
+        if not await ensure_group_context(m):
+            return
+        if not await is_privileged_user(bot, m):
+            await m.reply_text("Недостаточно прав для /remove.")
+            return
+        if len(m.command) < 2 or not m.command[1].isdigit() or int(m.command[1]) < 2:
+            await m.reply_text("Использование: /remove <номер в очереди, начиная с 2>")
+            return
+        removed = await queue.remove(m.chat.id, int(m.command[1]) - 1)
+        if not removed:
+            await m.reply_text("Нет трека с таким номером.")
+            return
+        if int(m.command[1]) == 2:
+            schedule_prefetch(m.chat.id)
+        await m.reply_text(f"Удалено из очереди: {removed.title}")
+
+    @bot.on_message(filters.command("move"))
+    async def move_cmd(_, m: Message):
+        if not await ensure_group_context(m):
+            return
+        if not await is_privileged_user(bot, m):
+            await m.reply_text("Недостаточно прав для /move.")
+            return
+        args = m.command[1:3]
+        if len(args) < 2 or not all(a.isdigit() and int(a) >= 2 for a in args):
+            await m.reply_text("Использование: /move <откуда> <куда> (номера в очереди, начиная с 2)")
+            return
+        moved = await queue.move(m.chat.id, int(args[0]) - 1, int(args[1]) - 1)
+        if not moved:
+            await m.reply_text("Нет трека с таким номером.")
+            return
+        if int(args[1]) == 2 or int(args[0]) == 2:
+            schedule_prefetch(m.chat.id)
+        await m.reply_text(f"Перемещено на #{args[1]}: {moved.title}")
+
     @bot.on_message(filters.command("now"))
     async def now_cmd(_, m: Message):
         if not await ensure_group_context(m):
@@ -579,34 +4146,585 @@ def main() -> None:
         if not tr:
             await m.reply_text("Сейчас ничего не играет.")
             return
+        position = int(playback_clock.position(m.chat.id))
         await m.reply_text(
             f"Сейчас играет: {tr.title}\n"
-            f"Длительность: {format_duration(tr.duration)}\n"
+            f"Позиция: {format_duration(position) if position else '0:00'} / {format_duration(tr.duration)}\n"
             f"Источник: {tr.webpage_url or 'n/a'}\n"
             f"Запросил: {tr.requested_by}"
         )
 
+    @bot.on_message(filters.command("stats"))
+    async def stats_cmd(_, m: Message):
+        if not await is_privileged_user(bot, m):
+            await m.reply_text("Недостаточно прав для /stats.")
+            return
+        await m.reply_text("\n".join(build_stats_lines()))
+
+    @bot.on_message(filters.command("profile"))
+    async def profile_cmd(_, m: Message):
+        if not await is_privileged_user(bot, m):
+            await m.reply_text("Недостаточно прав для /profile.")
+            return
+        seconds = PROFILE_SIGNAL_SECONDS
+        if len(m.command) > 1:
+            try:
+                seconds = int(m.command[1])
+            except ValueError:
+                await m.reply_text("Использование: /profile [секунды]")
+                return
+        seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+        task = profiler.start(seconds)
+        if task is None:
+            await m.reply_text("Профилирование уже идет.")
+            return
+        await m.reply_text(f"Профилирование запущено на {seconds} с.")
+        try:
+            path = await task
+        except Exception as exc:
+            logger.warning("Profiling failed: %s", exc)
+            await m.reply_text(f"Профилирование не удалось: {exc}")
+            return
+        await m.reply_text(f"Профиль сохранен: {path}")
+
+    @bot.on_message(filters.command("loop"))
+    async def loop_cmd(_, m: Message):
+        if not await is_privileged_user(bot, m):
+            await m.reply_text("Недостаточно прав для /loop.")
+            return
+        if not loop_monitor.enabled:
+            await m.reply_text("Мониторинг event loop выключен (LOOP_MONITOR_INTERVAL_MS=0).")
+            return
+        await m.reply_text(build_loop_report())
+
     @bot.on_message(filters.command("stop"))
     async def stop_cmd(_, m: Message):
         if not await ensure_group_context(m):
             return
-        await queue.clear(m.chat.id)
-        active_calls[m.chat.id] = False
-        current_track.pop(m.chat.id, None)
-        paused_calls.discard(m.chat.id)
-        task = reconnect_tasks.get(m.chat.id)
-        if task and not task.done():
-            task.cancel()
-        try:
-            await leave_call(calls, m.chat.id)
-        except Exception:
-            logger.warning("Failed to leave call in %s", m.chat.id)
+        await leave_chat(m.chat.id, calls)
         await m.reply_text("Остановлено, очередь очищена, вышел из звонка.")
 
+
+
+def start_user_sessions(user: ShardedUser, calls: ShardedCalls) -> None:
+    logger.info(
+        "Stream backend: url_play=True StreamAudioEnded=%s",
+        bool(StreamAudioEnded),
+    )
     user.start()
-    preload_user_dialogs(user)
     calls.start()
-    bot.run()
+
+
+ROUTED_COMMANDS = [
+    "play",
+    "search",
+    "pick",
+    "skip",
+    "pause",
+    "resume",
+    "unpause",
+    "reconnect",
+    "queue",
+    "remove",
+    "move",
+    "now",
+    "stop",
+    "stats",
+    "profile",
+    "loop",
+]
+PRIVILEGED_COMMANDS = {"skip", "reconnect", "remove", "move", "stats", "profile", "loop"}
+
+
+def partition_for(chat_id: int) -> int:
+    return abs(chat_id) % PARTITIONS
+
+
+def encode_message(message: Dict[str, Any]) -> bytes:
+    return (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class LocalBroker:
+    def __init__(self, host: str, port: int) -> None:
+        self._host = host
+        self._port = port
+        self._writers: Dict[str, asyncio.StreamWriter] = {}
+        self._front: Optional[asyncio.StreamWriter] = None
+
+    async def serve(
+        self,
+        on_message: Callable[[Dict[str, Any]], Awaitable[None]],
+        on_disconnect: Callable[[str], None],
+    ) -> None:
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            worker_id: Optional[str] = None
+            try:
+                async for line in reader:
+                    message = json.loads(line)
+                    if worker_id is None:
+                        worker_id = message.get("worker")
+                        self._writers[worker_id] = writer
+                    await on_message(message)
+            except (ConnectionError, ValueError) as exc:
+                logger.warning("Worker connection %s failed: %s", worker_id, exc)
+            finally:
+                if worker_id is not None and self._writers.get(worker_id) is writer:
+                    del self._writers[worker_id]
+                    on_disconnect(worker_id)
+                writer.close()
+
+        await asyncio.start_server(handle, self._host, self._port, limit=2**20)
+        logger.info("Broker listening on %s:%s", self._host, self._port)
+
+    async def send_to_worker(self, worker_id: str, message: Dict[str, Any]) -> bool:
+        writer = self._writers.get(worker_id)
+        if writer is None:
+            return False
+        writer.write(encode_message(message))
+        await writer.drain()
+        return True
+
+    async def connect(self, worker_id: str, on_message: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self._host, self._port, limit=2**20)
+            except OSError as exc:
+                logger.warning("Cannot reach front at %s:%s: %s", self._host, self._port, exc)
+                await asyncio.sleep(3)
+                continue
+            self._front = writer
+            await self.send_to_front({"type": "hello", "worker": worker_id})
+            try:
+                async for line in reader:
+                    await on_message(json.loads(line))
+            except (ConnectionError, ValueError) as exc:
+                logger.warning("Front connection failed: %s", exc)
+            self._front = None
+            writer.close()
+            logger.warning("Lost connection to front, reconnecting.")
+            await asyncio.sleep(3)
+
+    async def send_to_front(self, message: Dict[str, Any]) -> None:
+        if self._front is None:
+            raise ConnectionError("Front process is not connected.")
+        self._front.write(encode_message(message))
+        await self._front.drain()
+
+
+class RedisBroker:
+    FRONT_KEY = "tgstream:front"
+    WORKER_KEY = "tgstream:worker:{}"
+
+    def __init__(self, url: str) -> None:
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as exc:
+            raise RuntimeError("Install the 'redis' package to use a redis:// BROKER_URL.") from exc
+        self._redis = redis_asyncio.from_url(url, decode_responses=True)
+
+    async def _consume(self, key: str, on_message: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+        while True:
+            try:
+                item = await self._redis.blpop(key, timeout=5)
+            except Exception as exc:
+                logger.warning("Broker read from %s failed: %s", key, exc)
+                await asyncio.sleep(3)
+                continue
+            if item:
+                await on_message(json.loads(item[1]))
+
+    async def serve(
+        self,
+        on_message: Callable[[Dict[str, Any]], Awaitable[None]],
+        on_disconnect: Callable[[str], None],
+    ) -> None:
+        asyncio.create_task(self._consume(self.FRONT_KEY, on_message))
+        logger.info("Broker consuming %s", self.FRONT_KEY)
+
+    async def send_to_worker(self, worker_id: str, message: Dict[str, Any]) -> bool:
+        await self._redis.rpush(self.WORKER_KEY.format(worker_id), json.dumps(message, ensure_ascii=False))
+        return True
+
+    async def connect(self, worker_id: str, on_message: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+        await self._redis.delete(self.WORKER_KEY.format(worker_id))
+        await self.send_to_front({"type": "hello", "worker": worker_id})
+        await self._consume(self.WORKER_KEY.format(worker_id), on_message)
+
+    async def send_to_front(self, message: Dict[str, Any]) -> None:
+        await self._redis.rpush(self.FRONT_KEY, json.dumps(message, ensure_ascii=False))
+
+
+def make_broker(url: str) -> Any:
+    parsed = urlparse(url)
+    if parsed.scheme in ("redis", "rediss"):
+        return RedisBroker(url)
+    if parsed.scheme == "tcp":
+        return LocalBroker(parsed.hostname or "127.0.0.1", parsed.port or 8790)
+    raise RuntimeError(f"Unsupported BROKER_URL: {url}")
+
+
+class FrontRouter:
+    def __init__(self, bot: Client, broker: Any) -> None:
+        self._bot = bot
+        self._broker = broker
+        self.workers: Dict[str, float] = {}
+        self.owners: Dict[int, str] = {}
+        self.search_lists: Dict[int, int] = {}
+        self._relay_slots = asyncio.Semaphore(max(1, FRONT_RELAY_CONCURRENCY))
+
+    async def start(self) -> None:
+        await self._broker.serve(self.on_message, self.on_disconnect)
+        asyncio.create_task(self._expire_loop())
+
+    async def on_message(self, message: Dict[str, Any]) -> None:
+        worker_id = message.get("worker", "")
+        kind = message.get("type")
+        known = worker_id in self.workers
+        self.workers[worker_id] = time.monotonic()
+        if kind == "hello" or not known:
+            logger.info("Worker %s joined.", worker_id)
+            await self._rebalance()
+        elif kind == "send":
+            # Off the broker read loop: a slow send or FloodWait must not hold up other workers' heartbeats.
+            asyncio.create_task(self._relay(message))
+        elif kind == "notify":
+            outbox.send(self._bot, message["chat_id"], message["text"], message.get("key"))
+        elif kind == "reroute":
+            asyncio.create_task(self._reroute(message["envelope"]))
+
+    async def _relay(self, message: Dict[str, Any]) -> None:
+        async with self._relay_slots:
+            try:
+                sent = await self._bot.send_message(
+                    message["chat_id"],
+                    message["text"],
+                    reply_to_message_id=message.get("reply_to"),
+                    reply_markup=inline_keyboard(message["buttons"]) if message.get("buttons") else None,
+                )
+                buttons = message.get("buttons") or []
+                if any(data.startswith("pick:") for row in buttons for _, data in row):
+                    self.search_lists[message["chat_id"]] = sent.id
+            except Exception as exc:
+                logger.warning("Failed to relay message to %s: %s", message.get("chat_id"), exc)
+
+    def on_disconnect(self, worker_id: str) -> None:
+        if self.workers.pop(worker_id, None) is not None:
+            logger.warning("Worker %s disconnected.", worker_id)
+            asyncio.create_task(self._rebalance())
+
+    async def _expire_loop(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+            deadline = time.monotonic() - WORKER_TIMEOUT_SECONDS
+            expired = [worker_id for worker_id, seen in self.workers.items() if seen < deadline]
+            for worker_id in expired:
+                logger.warning("Worker %s timed out.", worker_id)
+                del self.workers[worker_id]
+            if expired:
+                await self._rebalance()
+
+    async def _rebalance(self) -> None:
+        workers = sorted(self.workers)
+        if workers:
+            self.owners = {
+                partition: max(workers, key=lambda worker_id: stable_hash(f"{worker_id}:{partition}"))
+                for partition in range(PARTITIONS)
+            }
+        else:
+            self.owners = {}
+        for worker_id in workers:
+            partitions = [p for p, owner in self.owners.items() if owner == worker_id]
+            try:
+                await self._broker.send_to_worker(worker_id, {"type": "assign", "partitions": partitions})
+            except Exception as exc:
+                logger.warning("Failed to send assignment to worker %s: %s", worker_id, exc)
+        logger.info("Partitions rebalanced across %s workers.", len(workers))
+
+    async def route(self, m: Message) -> None:
+        command = m.command[0].lower()
+        envelope = {
+            "type": "command",
+            "command": command,
+            "args": m.command,
+            "chat_id": m.chat.id,
+            "chat_type": m.chat.type.value,
+            "message_id": m.id,
+            "user_id": m.from_user.id if m.from_user else None,
+            "mention": m.from_user.mention if m.from_user else None,
+            "privileged": await is_privileged_user(self._bot, m) if command in PRIVILEGED_COMMANDS else False,
+        }
+        if not await self._deliver(envelope):
+            await m.reply_text("Нет доступных воркеров, попробуйте через минуту.")
+
+    async def _deliver(self, envelope: Dict[str, Any]) -> bool:
+        worker_id = self.owners.get(partition_for(envelope["chat_id"]))
+        if worker_id is None:
+            return False
+        try:
+            return await self._broker.send_to_worker(worker_id, envelope)
+        except Exception as exc:
+            logger.warning("Failed to route /%s to worker %s: %s", envelope["command"], worker_id, exc)
+            return False
+
+    async def _reroute(self, envelope: Dict[str, Any]) -> None:
+        # A worker bounced the command because it no longer owns the partition; give the assignment time to land.
+        envelope["hops"] = envelope.get("hops", 0) + 1
+        if envelope["hops"] <= 3:
+            await asyncio.sleep(0.5 * envelope["hops"])
+            if await self._deliver(envelope):
+                return
+        try:
+            await self._bot.send_message(
+                envelope["chat_id"],
+                "Нет доступных воркеров, попробуйте через минуту.",
+                reply_to_message_id=envelope["message_id"],
+            )
+        except Exception as exc:
+            logger.warning("Failed to reply in %s: %s", envelope["chat_id"], exc)
+
+
+class RemoteMessage:
+    def __init__(self, bot: "RemoteBot", envelope: Dict[str, Any]) -> None:
+        self._bot = bot
+        self.id = envelope["message_id"]
+        self.chat = SimpleNamespace(id=envelope["chat_id"], type=ChatType(envelope["chat_type"]))
+        self.from_user = None
+        if envelope.get("user_id") is not None:
+            self.from_user = SimpleNamespace(id=envelope["user_id"], mention=envelope.get("mention") or "unknown")
+        self.command = envelope["args"]
+        self.privileged = bool(envelope.get("privileged"))
+
+    async def reply_text(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, **kwargs: Any) -> None:
+        buttons = None
+        if reply_markup is not None:
+            buttons = [[(button.text, button.callback_data) for button in row] for row in reply_markup.inline_keyboard]
+        await self._bot.send_message(self.chat.id, text, reply_to_message_id=self.id, buttons=buttons)
+
+
+class RemoteBot:
+    def __init__(self, broker: Any, worker_id: str) -> None:
+        self._broker = broker
+        self._worker_id = worker_id
+        self._handlers: Dict[str, Callable] = {}
+
+    def on_message(self, flt: Any = None, *args: Any, **kwargs: Any) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            for command in getattr(flt, "commands", ()):
+                self._handlers[command.lower()] = func
+            return func
+
+        return decorator
+
+    async def send_message(
+        self,
+        chat_id: int,
+        text: str,
+        reply_to_message_id: Optional[int] = None,
+        buttons: Optional[List[List[Tuple[str, str]]]] = None,
+        **kwargs: Any,
+    ):
+        await self._broker.send_to_front(
+            {
+                "type": "send",
+                "worker": self._worker_id,
+                "chat_id": chat_id,
+                "text": text,
+                "reply_to": reply_to_message_id,
+                "buttons": buttons,
+            }
+        )
+
+    def forward_notification(self, chat_id: int, text: str, key: Optional[str]) -> None:
+        async def forward() -> None:
+            try:
+                await self._broker.send_to_front(
+                    {"type": "notify", "worker": self._worker_id, "chat_id": chat_id, "text": text, "key": key}
+                )
+            except Exception as exc:
+                logger.warning("Failed to forward notification for %s: %s", chat_id, exc)
+
+        asyncio.create_task(forward())
+
+    async def get_chat_member(self, chat_id: int, user_id: int) -> Any:
+        raise RuntimeError("Chat member lookups are done by the front process.")
+
+    async def dispatch(self, envelope: Dict[str, Any]) -> None:
+        handler = self._handlers.get(envelope["command"])
+        if handler is None:
+            return
+        try:
+            await handler(self, RemoteMessage(self, envelope))
+        except Exception:
+            logger.exception("Routed command /%s failed in chat %s", envelope["command"], envelope["chat_id"])
+
+
+class WorkerNode:
+    def __init__(self, broker: Any, worker_id: str, bot: RemoteBot, calls: PyTgCalls, user: Client) -> None:
+        self._broker = broker
+        self._worker_id = worker_id
+        self._bot = bot
+        self._calls = calls
+        self._user = user
+        self.partitions: Set[int] = set()
+        self._assigned_once = False
+
+    async def on_message(self, message: Dict[str, Any]) -> None:
+        kind = message.get("type")
+        if kind == "command":
+            if partition_for(message["chat_id"]) not in self.partitions:
+                logger.info("Bouncing /%s for chat %s: partition not owned.", message["command"], message["chat_id"])
+                try:
+                    await self._broker.send_to_front({"type": "reroute", "worker": self._worker_id, "envelope": message})
+                except Exception as exc:
+                    logger.warning("Failed to bounce /%s back to the front: %s", message["command"], exc)
+                return
+            asyncio.create_task(self._bot.dispatch(message))
+        elif kind == "assign":
+            await self._assign(set(message["partitions"]))
+
+    async def _assign(self, partitions: Set[int]) -> None:
+        released = self.partitions - partitions
+        acquired = partitions - self.partitions
+        self.partitions = partitions
+        logger.info("Worker owns %s partitions (+%s/-%s).", len(partitions), len(acquired), len(released))
+        if released:
+            await self._release(released)
+        if acquired:
+            delay = WORKER_HANDOFF_SECONDS if self._assigned_once else 0
+            asyncio.create_task(self._acquire(acquired, delay))
+        self._assigned_once = True
+
+    async def _release(self, partitions: Set[int]) -> None:
+        chat_ids = {
+            chat_id
+            for chat_id in set(active_calls) | set(current_track) | set(queue.chat_ids())
+            if partition_for(chat_id) in partitions
+        }
+        await playback_clock.checkpoint()
+        await state_store.flush()
+        for chat_id in chat_ids:
+            if active_calls.get(chat_id):
+                try:
+                    await leave_call(self._calls, chat_id)
+                except Exception:
+                    logger.warning("Failed to leave call in %s", chat_id)
+            forget_chat(chat_id)
+        logger.info("Handed off %s chats.", len(chat_ids))
+
+    async def _acquire(self, partitions: Set[int], delay: float) -> None:
+        await asyncio.sleep(delay)
+        await restore_state(
+            self._calls,
+            self._bot,
+            self._user,
+            lambda chat_id: partition_for(chat_id) in partitions and partition_for(chat_id) in self.partitions,
+        )
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+            try:
+                await self._broker.send_to_front({"type": "heartbeat", "worker": self._worker_id})
+            except Exception as exc:
+                logger.debug("Heartbeat failed: %s", exc)
+
+    async def run(self) -> None:
+        if METRICS_PORT > 0:
+            await metrics.serve(METRICS_HOST, METRICS_PORT)
+        install_profile_signal()
+        loop_monitor.start()
+        await peer_cache.start(session_pool.shards)
+        if library.enabled:
+            asyncio.create_task(library.run(LIBRARY_RESCAN_SECONDS))
+        if REAPER_INTERVAL_SECONDS > 0:
+            asyncio.create_task(reaper.run(REAPER_INTERVAL_SECONDS, self._calls, self._bot))
+        if state_store.enabled and POSITION_CHECKPOINT_SECONDS > 0:
+            asyncio.create_task(playback_clock.run(POSITION_CHECKPOINT_SECONDS))
+        asyncio.create_task(self._heartbeat())
+        await self._broker.connect(self._worker_id, self.on_message)
+
+
+def run_front() -> None:
+    bot = build_bot_client()
+    router = FrontRouter(bot, make_broker(BROKER_URL))
+    register_basic_handlers(bot)
+
+    @bot.on_message(filters.command(ROUTED_COMMANDS))
+    async def routed_cmd(_, m: Message):
+        await router.route(m)
+
+    register_pick_shortcuts(bot, router.route, router.search_lists.get)
+
+    async def run_bot() -> None:
+        await bot.start()
+        await router.start()
+        install_profile_signal()
+        loop_monitor.start()
+        await idle()
+        await bot.stop()
+
+    bot.run(run_bot())
+
+
+def run_worker() -> None:
+    broker = make_broker(BROKER_URL)
+    bot = RemoteBot(broker, WORKER_ID)
+    user, calls = build_user_clients()
+    register_handlers(bot, calls, user)
+    audio_cache.start()
+    start_user_sessions(user, calls)
+    node = WorkerNode(broker, WORKER_ID, bot, calls, user)
+    logger.info("Worker %s connecting to %s", WORKER_ID, BROKER_URL)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(node.run())
+    finally:
+        loop.run_until_complete(playback_clock.checkpoint())
+        loop.run_until_complete(state_store.flush())
+        loop.run_until_complete(peer_cache.flush())
+        tracer.flush()
+
+
+def run_single() -> None:
+    bot, user, calls = build_clients()
+    register_basic_handlers(bot)
+    register_handlers(bot, calls, user)
+    register_pick_shortcuts(bot, lambda m: pick_candidate(m, calls, bot, user), search_list_id)
+    audio_cache.start()
+
+    async def run_bot() -> None:
+        await bot.start()
+        if METRICS_PORT > 0:
+            await metrics.serve(METRICS_HOST, METRICS_PORT)
+        install_profile_signal()
+        loop_monitor.start()
+        await peer_cache.start(session_pool.shards)
+        if library.enabled:
+            asyncio.create_task(library.run(LIBRARY_RESCAN_SECONDS))
+        if REAPER_INTERVAL_SECONDS > 0:
+            asyncio.create_task(reaper.run(REAPER_INTERVAL_SECONDS, calls, bot))
+        if state_store.enabled and POSITION_CHECKPOINT_SECONDS > 0:
+            asyncio.create_task(playback_clock.run(POSITION_CHECKPOINT_SECONDS))
+        restore_task = asyncio.create_task(restore_state(calls, bot, user))
+        await idle()
+        restore_task.cancel()
+        await playback_clock.checkpoint()
+        await state_store.flush()
+        await peer_cache.flush()
+        tracer.flush()
+        await bot.stop()
+
+    start_user_sessions(user, calls)
+    bot.run(run_bot())
+
+
+def main() -> None:
+    if RUN_MODE == "front":
+        run_front()
+    elif RUN_MODE == "worker":
+        run_worker()
+    else:
+        run_single()
 
 
 if __name__ == "__main__":
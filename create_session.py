@@ -1,4 +1,5 @@
 import os
+import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -10,23 +11,33 @@ load_dotenv()
 API_ID = int(os.getenv("API_ID", "0"))
 API_HASH = os.getenv("API_HASH", "")
 SESSION_NAME = os.getenv("SESSION_NAME", "music_user")
+SESSION_NAMES = os.getenv("SESSION_NAMES", "")
 SESSION_DIR = os.getenv("SESSION_DIR", "data/sessions")
 
 if not API_ID or not API_HASH:
     raise RuntimeError("Set API_ID and API_HASH in environment variables.")
 
 Path(SESSION_DIR).mkdir(parents=True, exist_ok=True)
-session_path = str(Path(SESSION_DIR) / SESSION_NAME)
 
-print(f"Creating Telegram user session: {session_path}")
-print("Enter phone number and code when prompted.")
+names = sys.argv[1:] or [name.strip() for name in SESSION_NAMES.split(",") if name.strip() and name.strip() != "*"]
+if not names:
+    names = [SESSION_NAME]
 
-app = Client(
-    name=session_path,
-    api_id=API_ID,
-    api_hash=API_HASH,
-)
+for name in names:
+    session_path = str(Path(SESSION_DIR) / name)
+    if Path(f"{session_path}.session").exists():
+        print(f"Session already exists, skipping: {session_path}")
+        continue
 
-with app:
-    me = app.get_me()
-    print(f"Session created for: {me.first_name} (@{me.username or 'no_username'})")
+    print(f"Creating Telegram user session: {session_path}")
+    print("Enter phone number and code when prompted.")
+
+    app = Client(
+        name=session_path,
+        api_id=API_ID,
+        api_hash=API_HASH,
+    )
+
+    with app:
+        me = app.get_me()
+        print(f"Session created for: {me.first_name} (@{me.username or 'no_username'})")